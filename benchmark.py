@@ -0,0 +1,542 @@
+"""Нагрузочный стенд бота без реального сервера и Telegram.
+
+Поднимает в отдельном процессе SSH-заглушку на paramiko со скриптованными задержками команд, в текущем
+процессе — поддельный Bot API, направляет на них настоящий Application из main.py и прогоняет сценарии:
+много дашбордов, всплеск оповещений, крупные выгрузки /logs, отзывчивость кнопок во время выгрузок
+и /fleet по парку. Для каждого сценария
+печатает перцентили задержки тиков JobQueue, SSH-рукопожатия в минуту, время остановок цикла событий
+и пиковый RSS.
+
+    python benchmark.py --scenario all --hosts 20 --dashboards 50 --json report.json
+"""
+import os
+import re
+import shlex
+import sys
+import json
+import gzip
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+
+import paramiko
+
+ADMIN_ID = 1000
+BENCH_LOG_LINE = b"2024-01-01T00:00:00 bench[1234]: request handled in 12ms status=200 path=/api/v1/items\n"
+
+# --- SSH-заглушка (отдельный процесс, чтобы ее память и GIL не влияли на замеры бота) ---
+class StubHost:
+    """Состояние одного SSH-соединения: монотонно растущие счетчики /proc, как у настоящего хоста."""
+
+    def __init__(self, busy):
+        self.busy = busy
+        self.started = time.monotonic()
+        self.cpu_total = 0.0
+        self.cpu_idle = 0.0
+        self.updated = self.started
+        self.net = 0
+        self.lock = threading.Lock()
+
+    def metrics(self) -> bytes:
+        with self.lock:
+            now = time.monotonic()
+            ticks = (now - self.updated) * 100 * 4
+            self.cpu_total += ticks
+            self.cpu_idle += ticks * (0.02 if self.busy.value else 0.8)
+            self.updated = now
+            self.net += int((now - self.started) * 1000)
+            return (
+                f"cpu_total={self.cpu_total:.0f}\ncpu_idle={self.cpu_idle:.0f}\ncpu_count=4\n"
+                f"MemTotal={8 << 30}\nMemAvailable={(1 << 30) if self.busy.value else (5 << 30)}\n"
+                f"SwapTotal={2 << 30}\nSwapFree={2 << 30}\n"
+                f"load1=0.50\nload5=0.40\nload15=0.30\nuptime={1000 + now - self.started:.2f}\n"
+                f"net_rx={self.net}\nnet_tx={self.net // 2}\n"
+                f"disk_total={100 << 30}\ndisk_used={40 << 30}\ndisk_avail={60 << 30}\n"
+            ).encode()
+
+
+class StubServer(paramiko.ServerInterface):
+    def __init__(self, host: StubHost, stats, options):
+        self.host = host
+        self.stats = stats
+        self.options = options
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        with self.stats.get_lock():
+            self.stats[1] += 1
+        threading.Thread(target=self.respond, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def respond(self, channel: paramiko.Channel, command: str):
+        """Отвечает на команду по сценарию: задержка, затем вывод порциями по 64 КБ."""
+        latency, jitter, log_bytes = self.options
+        if command.startswith("timeout "):
+            command = shlex.split(command)[-1]  # бот оборачивает команды в удаленный timeout ... sh -c '...'
+        time.sleep(latency + random.expovariate(1 / jitter) if jitter else latency)
+        try:
+            if "cpu_total=" in command:
+                channel.sendall(self.host.metrics())
+            elif command.startswith("tail -n"):
+                limit = int(re.search(r"tail -c (\d+)", command).group(1))
+                size = min(log_bytes, limit)
+                body = BENCH_LOG_LINE * (size // len(BENCH_LOG_LINE) + 1)
+                body = body[:size]
+                if "gzip" in command:
+                    body = gzip.compress(body, 1)
+                for offset in range(0, len(body), 65536):
+                    channel.sendall(body[offset:offset + 65536])
+            elif command != "true":
+                channel.sendall(f"bench: {command}\n".encode())
+            channel.send_exit_status(0)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+
+def run_ssh_stub(port_pipe, stats, busy, options):
+    """Точка входа процесса-заглушки: принимает соединения и обслуживает каждое в своем потоке."""
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(512)
+    port_pipe.send(listener.getsockname()[1])
+
+    def serve(sock):
+        with stats.get_lock():
+            stats[0] += 1
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.start_server(server=StubServer(StubHost(busy), stats, options))
+        while transport.is_active():
+            time.sleep(0.5)
+
+    while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+
+# --- Поддельный Bot API ---
+class FakeBotAPI:
+    """HTTP/1.1-сервер с keep-alive, отвечающий на методы Bot API правдоподобными объектами."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self.events = []  # (время, метод, chat_id)
+        self._message_ids = 0
+        self._changed = asyncio.Condition()
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+
+    def count(self, method: str, chat_id=None) -> int:
+        return sum(1 for _, m, chat in self.events if m == method and (chat_id is None or chat == chat_id))
+
+    async def wait_for(self, method: str, count: int, timeout: float, chat_id=None):
+        async with self._changed:
+            await asyncio.wait_for(self._changed.wait_for(lambda: self.count(method, chat_id) >= count), timeout)
+
+    @staticmethod
+    def _parse(headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            return {name.decode(): value.decode(errors="replace") for name, value in
+                    re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S) if len(value) < 4096}
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return dict(parse_qsl(body.decode()))
+
+    def _result(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id", ADMIN_ID))
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            if method == "editMessageText":
+                message_id = int(params["message_id"])
+            else:
+                self._message_ids += 1
+                message_id = self._message_ids
+            message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+            if "text" in params:
+                message["text"] = params["text"]
+            if method == "sendDocument":
+                message["document"] = {"file_id": f"bench-{message_id}", "file_unique_id": f"bench-{message_id}"}
+            return message
+        return True
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = request_line.split()[1].decode().rsplit("/", 1)[-1]
+                params = self._parse(headers, body)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = json.dumps({"ok": True, "result": self._result(method, params)}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                self.calls[method] += 1
+                async with self._changed:
+                    self.events.append((time.monotonic(), method, int(params.get("chat_id", 0) or 0)))
+                    self._changed.notify_all()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# --- Замеры ---
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(values: list) -> dict:
+    return {'n': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99), 'max': max(values, default=0.0)}
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class Probe:
+    """Собирает метрики сценария: задержки тиков JobQueue, остановки цикла событий и пик RSS."""
+
+    def __init__(self, stall_threshold=0.05, interval=0.01):
+        self.stall_threshold = stall_threshold
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.ticks = defaultdict(list)
+        self.stalls = []
+        self.peak_rss = current_rss()
+        self.started = time.monotonic()
+
+    def on_job_executed(self, event):
+        """Задержка тика: от запланированного времени запуска задачи до ее завершения."""
+        name = self.job_names.get(event.job_id, event.job_id)
+        self.ticks[name].append((datetime.now(timezone.utc) - event.scheduled_run_time).total_seconds())
+
+    def attach(self, application):
+        from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+        self.scheduler = application.job_queue.scheduler
+        self.job_names = {}
+
+        def on_added(event):
+            # Разовые задачи к моменту завершения уже удалены из планировщика, поэтому имя запоминаем заранее.
+            job = self.scheduler.get_job(event.job_id)
+            if job is not None:
+                self.job_names[event.job_id] = job.args[1].callback.__name__
+
+        self.scheduler.add_listener(on_added, EVENT_JOB_ADDED)
+        self.scheduler.add_listener(self.on_job_executed, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+
+    async def watch_loop(self):
+        """Спит короткими интервалами: все, на что сон затянулся сверх порога, — остановка цикла событий."""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            if lag > self.stall_threshold:
+                self.stalls.append(lag)
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def report(self) -> dict:
+        return {
+            'duration': time.monotonic() - self.started,
+            'ticks': {name: summarize(values) for name, values in self.ticks.items()},
+            'stalls': {'count': len(self.stalls), 'total': sum(self.stalls), 'max': max(self.stalls, default=0.0)},
+            'peak_rss': self.peak_rss,
+        }
+
+
+# --- Сценарии ---
+class Bench:
+    def __init__(self, bot, application, api: FakeBotAPI, stats, busy, args):
+        self.bot = bot
+        self.application = application
+        self.api = api
+        self.stats = stats
+        self.busy = busy
+        self.args = args
+        self.probe = Probe(args.stall_threshold)
+        self.webhook = None  # (httpx-клиент, адрес), если обновления идут через вебхук
+        self._update_ids = 0
+
+    def _user(self):
+        return {"id": ADMIN_ID, "is_bot": False, "first_name": "bench"}
+
+    async def deliver(self, payload: dict):
+        """Передает обновление боту: POST-запросом в вебхук, как это делает Telegram, или прямо в очередь."""
+        from telegram import Update
+        if self.webhook:
+            client, url = self.webhook
+            response = await client.post(url, json=payload, headers={"X-Telegram-Bot-Api-Secret-Token": "bench"})
+            response.raise_for_status()
+        else:
+            await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+
+    async def send_command(self, text: str):
+        self._update_ids += 1
+        command = text.split()[0]
+        message = {
+            "message_id": 10 ** 6 + self._update_ids, "date": int(time.time()), "text": text,
+            "chat": {"id": ADMIN_ID, "type": "private"}, "from": self._user(),
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }
+        await self.deliver({"update_id": self._update_ids, "message": message})
+
+    async def press_button(self, data: str, message_id=1):
+        self._update_ids += 1
+        query = {
+            "id": str(self._update_ids), "from": self._user(), "chat_instance": "bench", "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": ADMIN_ID, "type": "private"}, "text": "menu"},
+        }
+        await self.deliver({"update_id": self._update_ids, "callback_query": query})
+
+    async def scenario_dashboards(self) -> dict:
+        """N живых дашбордов (по одному на чат) плюс нажатия кнопок сводки от администратора."""
+        edits, jobs = self.api.count("editMessageText"), []
+        for n in range(self.args.dashboards):
+            host = self.bot.hosts[n % len(self.bot.hosts)]
+            jobs.append(self.application.job_queue.run_repeating(
+                self.bot.update_dashboard_job, interval=self.args.tick, first=random.uniform(0, self.args.tick),
+                chat_id=ADMIN_ID + 1 + n, data={'message_id': n + 1, 'host': host}, name=f"bench_dashboard_{n}",
+            ))
+        deadline = time.monotonic() + self.args.duration
+        while time.monotonic() < deadline:
+            await self.press_button("get_summary")
+            await asyncio.sleep(1)
+        for job in jobs:
+            job.schedule_removal()
+        return {'edits': self.api.count("editMessageText") - edits}
+
+    async def scenario_alerts(self) -> dict:
+        """Все хосты одновременно уходят в высокую нагрузку: время до первого оповещения и число сообщений."""
+        sent = self.api.count("sendMessage", ADMIN_ID)
+        self.busy.value = 1
+        started = time.monotonic()
+        try:
+            await self.api.wait_for("sendMessage", sent + 1, self.args.duration + self.bot.ALERT_DURATION, ADMIN_ID)
+            first_alert = time.monotonic() - started
+        except asyncio.TimeoutError:
+            first_alert = None
+        await asyncio.sleep(max(self.args.duration - (time.monotonic() - started), 0))
+        self.busy.value = 0
+        await asyncio.sleep(self.bot.ALERT_DURATION + 2 * self.bot.ALERT_BATCH_INTERVAL)
+        return {'first_alert': first_alert, 'alert_messages': self.api.count("sendMessage", ADMIN_ID) - sent}
+
+    async def scenario_logs(self) -> dict:
+        """Несколько разных /logs подряд, каждый выгружает log-mb мегабайт (одинаковые запросы бот объединяет в одну задачу)."""
+        sent = self.api.count("sendDocument")
+        started = time.monotonic()
+        for n in range(self.args.log_pulls):
+            await self.send_command(f"/logs {1000000 + n} /var/log/bench.log")
+        await self.api.wait_for("sendDocument", sent + self.args.log_pulls, self.args.duration * 10)
+        elapsed = time.monotonic() - started
+        return {'pulls': self.args.log_pulls, 'total_seconds': elapsed, 'mb_per_second': self.args.log_pulls * self.args.log_mb / elapsed}
+
+    async def scenario_responsive(self) -> dict:
+        """Нажатия кнопок на фоне крупных выгрузок /logs: через сколько приходит ответ на callback."""
+        sent = self.api.count("sendDocument")
+        for n in range(self.args.log_pulls):
+            await self.send_command(f"/logs {2000000 + n} /var/log/bench.log")
+        latencies = []
+        while self.api.count("sendDocument") < sent + self.args.log_pulls and len(latencies) < 100:
+            answered = self.api.count("answerCallbackQuery")
+            started = time.monotonic()
+            await self.press_button("main_menu")
+            await self.api.wait_for("answerCallbackQuery", answered + 1, self.args.duration * 10)
+            latencies.append(time.monotonic() - started)
+            await asyncio.sleep(0.1)
+        await self.api.wait_for("sendDocument", sent + self.args.log_pulls, self.args.duration * 10)
+        return {'button_answer': summarize(latencies)}
+
+    async def scenario_fleet(self) -> dict:
+        """/fleet по всему парку несколько раз подряд на фоне регулярного сэмплирования метрик."""
+        durations = []
+        for _ in range(self.args.fleet_runs):
+            sent = self.api.count("sendDocument")
+            started = time.monotonic()
+            await self.send_command("/fleet uptime")
+            await self.api.wait_for("sendDocument", sent + 1, self.args.duration * 10)
+            durations.append(time.monotonic() - started)
+        return {'fleet_command': summarize(durations)}
+
+    async def run(self, name: str) -> dict:
+        handshakes, execs = self.stats[0], self.stats[1]
+        self.probe.reset()
+        result = await getattr(self, f"scenario_{name}")()
+        report = self.probe.report()
+        minutes = report['duration'] / 60
+        report.update(result)
+        report['ssh'] = {
+            'handshakes': self.stats[0] - handshakes,
+            'handshakes_per_minute': (self.stats[0] - handshakes) / minutes,
+            'execs_per_minute': (self.stats[1] - execs) / minutes,
+        }
+        return report
+
+
+def print_report(name: str, report: dict):
+    print(f"\n== {name} ({report['duration']:.1f} s)")
+    for job, s in sorted(report['ticks'].items()):
+        print(f"  tick {job:<28} n={s['n']:<5} p50={s['p50'] * 1000:7.1f}ms p95={s['p95'] * 1000:7.1f}ms "
+              f"p99={s['p99'] * 1000:7.1f}ms max={s['max'] * 1000:7.1f}ms")
+    ssh, stalls = report['ssh'], report['stalls']
+    print(f"  ssh handshakes={ssh['handshakes']} ({ssh['handshakes_per_minute']:.1f}/min), execs {ssh['execs_per_minute']:.0f}/min")
+    print(f"  loop stalls >{report['stall_threshold'] * 1000:.0f}ms: {stalls['count']}, total {stalls['total']:.3f} s, max {stalls['max'] * 1000:.1f}ms")
+    print(f"  peak RSS {report['peak_rss'] / 2 ** 20:.1f} MB")
+    for key, value in report.items():
+        if key not in ('duration', 'ticks', 'ssh', 'stalls', 'peak_rss', 'stall_threshold'):
+            print(f"  {key}: {value}")
+
+
+async def run_bench(args, port: int, stats, busy) -> dict:
+    api = FakeBotAPI(args.api_latency)
+    os.environ["TELEGRAM_BASE_URL"] = f"http://127.0.0.1:{await api.start()}/bot"
+    import main as bot  # настройки main.py читаются из окружения при импорте
+
+    bot.init_ssh_connections()
+    application = bot.build_application()
+    bench = Bench(bot, application, api, stats, busy, args)
+    bench.probe.attach(application)
+    await application.initialize()
+    if args.mode == "webhook":
+        import httpx
+        with socket.socket() as probe_socket:
+            probe_socket.bind(("127.0.0.1", 0))
+            webhook_port = probe_socket.getsockname()[1]
+        url = f"http://127.0.0.1:{webhook_port}/bench"
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=webhook_port, url_path="bench", webhook_url=url, secret_token="bench",
+        )
+        bench.webhook = (httpx.AsyncClient(), url)
+    await application.start()
+    await bot.start_background_tasks(application)
+    watcher = asyncio.create_task(bench.probe.watch_loop())
+    reports = {}
+    try:
+        for name in args.scenarios:
+            reports[name] = await bench.run(name)
+            reports[name]['stall_threshold'] = args.stall_threshold
+            print_report(name, reports[name])
+    finally:
+        watcher.cancel()
+        if bench.webhook:
+            await bench.webhook[0].aclose()
+            await application.updater.stop()
+        await application.stop()
+        await bot.stop_background_tasks(application)
+        await application.shutdown()
+        await api.stop()
+    reports['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    reports['bot_api_calls'] = dict(api.calls)
+    if args.verbose:
+        print("\n" + bot.instrumentation.render_text())
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота на локальной SSH-заглушке и поддельном Bot API.")
+    parser.add_argument("--scenario", action="append", choices=["dashboards", "alerts", "logs", "responsive", "fleet"],
+                        help="сценарий; можно указать несколько раз, по умолчанию — все")
+    parser.add_argument("--mode", choices=["queue", "webhook"], default="queue",
+                        help="как доставлять обновления: прямо в очередь Application или через локальный вебхук")
+    parser.add_argument("--hosts", type=int, default=10, help="размер парка")
+    parser.add_argument("--dashboards", type=int, default=20, help="число одновременных дашбордов")
+    parser.add_argument("--tick", type=float, default=2.0, help="период обновления дашборда, сек")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность сценариев дашбордов и оповещений, сек")
+    parser.add_argument("--log-mb", type=float, default=20.0, help="размер лога в /logs, МБ")
+    parser.add_argument("--log-pulls", type=int, default=3, help="число выгрузок /logs")
+    parser.add_argument("--fleet-runs", type=int, default=5, help="число запусков /fleet")
+    parser.add_argument("--ssh-latency", type=float, default=0.02, help="базовая задержка ответа на команду, сек")
+    parser.add_argument("--ssh-jitter", type=float, default=0.01, help="среднее экспоненциального разброса задержки, сек")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="задержка ответа Bot API, сек")
+    parser.add_argument("--stall-threshold", type=float, default=0.05, help="порог остановки цикла событий, сек")
+    parser.add_argument("--seed", type=int, default=1, help="seed случайных задержек")
+    parser.add_argument("--json", help="сохранить отчет в JSON-файл")
+    parser.add_argument("--verbose", action="store_true", help="вывести в конце внутреннюю статистику бота")
+    args = parser.parse_args()
+    args.scenarios = args.scenario or ["dashboards", "alerts", "logs", "responsive", "fleet"]
+    random.seed(args.seed)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    workdir = tempfile.mkdtemp(prefix="tgstatus-bench-")
+    key_path = os.path.join(workdir, "id_rsa")
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+
+    stats = multiprocessing.Array('q', 2)  # рукопожатия, exec-запросы
+    busy = multiprocessing.Value('b', 0)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    stub = multiprocessing.Process(
+        target=run_ssh_stub, args=(sender, stats, busy, (args.ssh_latency, args.ssh_jitter, int(args.log_mb * 2 ** 20))),
+        daemon=True,
+    )
+    stub.start()
+    port = receiver.recv()
+
+    with open(os.path.join(workdir, "hosts.json"), "w") as f:
+        json.dump([{'name': f"bench-{n:02d}", 'host': "127.0.0.1", 'port': port} for n in range(args.hosts)], f)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "ADMIN_USER_ID": str(ADMIN_ID),
+        "SSH_HOST": "127.0.0.1", "SSH_PORT": str(port), "SSH_USER": "bench", "SSH_KEY_PATH": key_path,
+        "HOSTS_FILE": os.path.join(workdir, "hosts.json"), "HISTORY_DIR": os.path.join(workdir, "history"),
+        "METRICS_SAMPLE_INTERVAL": "1", "ALERT_DURATION": "5", "ALERT_BATCH_INTERVAL": "1",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)  # bot.log и история пишутся во временный каталог
+
+    try:
+        reports = asyncio.run(run_bench(args, port, stats, busy))
+    finally:
+        stub.terminate()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+    print(f"\npeak RSS (process) {reports['max_rss'] / 2 ** 20:.1f} MB, workdir {workdir}")
+
+if __name__ == "__main__":
+    main()
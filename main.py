@@ -1,12 +1,27 @@
 import os
+import io
+import html
+import json
 import logging
+import mmap
 from logging.handlers import RotatingFileHandler
 import re
+import shlex
 import asyncio
-import uuid
-from functools import wraps
+import time
+import tempfile
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from functools import partial, wraps
+from typing import NamedTuple
 
 import paramiko
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -16,10 +31,12 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     ContextTypes,
+    Job,
     filters,
 )
+from telegram.request import HTTPXRequest
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 # --- Загрузка и настройка ---
 load_dotenv()
@@ -34,6 +51,69 @@ SSH_KEY_PATH = os.getenv("SSH_KEY_PATH")
 CPU_THRESHOLD = float(os.getenv("CPU_THRESHOLD", 90.0))
 RAM_THRESHOLD = float(os.getenv("RAM_THRESHOLD", 90.0))
 DISK_THRESHOLD = float(os.getenv("DISK_THRESHOLD", 95.0))
+SSH_KEEPALIVE_INTERVAL = int(os.getenv("SSH_KEEPALIVE_INTERVAL", 30))
+SSH_MAX_CHANNELS = int(os.getenv("SSH_MAX_CHANNELS", 8))
+SSH_RECONNECT_MAX_DELAY = float(os.getenv("SSH_RECONNECT_MAX_DELAY", 60.0))
+SSH_COMMAND_TIMEOUT = float(os.getenv("SSH_COMMAND_TIMEOUT", 30.0))
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", 10.0))
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", 15.0))
+METRICS_MODE = os.getenv("METRICS_MODE", "poll")  # poll | stream
+METRICS_STREAM_INTERVAL = float(os.getenv("METRICS_STREAM_INTERVAL", 1.0))
+METRICS_STREAM_STALL_TIMEOUT = float(os.getenv("METRICS_STREAM_STALL_TIMEOUT", 5.0))
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 20 * 1024 * 1024))
+FOLLOW_INTERVAL = float(os.getenv("FOLLOW_INTERVAL", 5.0))
+FOLLOW_MAX_BYTES = int(os.getenv("FOLLOW_MAX_BYTES", 64 * 1024))
+GREP_MAX_MATCHES = int(os.getenv("GREP_MAX_MATCHES", 10000))
+GREP_PAGE_SIZE = int(os.getenv("GREP_PAGE_SIZE", 10))
+GREP_CACHE_SIZE = int(os.getenv("GREP_CACHE_SIZE", 50))
+PROCESS_CACHE_TTL = float(os.getenv("PROCESS_CACHE_TTL", 60.0))
+PROCESS_PAGE_SIZE = int(os.getenv("PROCESS_PAGE_SIZE", 10))
+FACT_SLOW_TTL = float(os.getenv("FACT_SLOW_TTL", 300.0))
+TASK_RESULT_TTL = float(os.getenv("TASK_RESULT_TTL", 300.0))
+TASK_PROGRESS_INTERVAL = float(os.getenv("TASK_PROGRESS_INTERVAL", 3.0))
+DISK_INDEX_TTL = float(os.getenv("DISK_INDEX_TTL", 600.0))
+DISK_SCAN_TIMEOUT = float(os.getenv("DISK_SCAN_TIMEOUT", 1800.0))
+DISK_RESCAN_TOP = int(os.getenv("DISK_RESCAN_TOP", 20))
+DISK_PAGE_SIZE = int(os.getenv("DISK_PAGE_SIZE", 10))
+DISK_FS_TYPES = os.getenv("DISK_FS_TYPES", "ext2,ext3,ext4,xfs,btrfs,zfs,f2fs,jfs,reiserfs,vfat,exfat,ntfs,ntfs3,fuseblk").split(",")
+HOSTS_FILE = os.getenv("HOSTS_FILE", "hosts.json")
+FLEET_PARALLELISM = int(os.getenv("FLEET_PARALLELISM", 20))
+SSH_CHANNEL_THREADS = int(os.getenv("SSH_CHANNEL_THREADS", FLEET_PARALLELISM))
+FLEET_WORST_COUNT = int(os.getenv("FLEET_WORST_COUNT", 5))
+ALERT_DURATION = float(os.getenv("ALERT_DURATION", 120.0))
+ALERT_HYSTERESIS = float(os.getenv("ALERT_HYSTERESIS", 5.0))
+ALERT_BATCH_INTERVAL = float(os.getenv("ALERT_BATCH_INTERVAL", 10.0))
+ALERT_RATE_LIMIT = int(os.getenv("ALERT_RATE_LIMIT", 6))  # сообщений в минуту
+# Пропуск в замерах длиннее этого (простой, перезапуск сэмплера) обнуляет окно правила.
+ALERT_MAX_GAP = float(os.getenv(
+    "ALERT_MAX_GAP", 3 * (METRICS_STREAM_INTERVAL if METRICS_MODE == "stream" else METRICS_SAMPLE_INTERVAL)
+))
+# Лимиты Bot API: около 30 сообщений в секунду на бота и 1 в секунду на чат.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30.0))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1.0))
+# В режиме стрима дашборд обновляется с частотой замеров, но не чаще, чем позволяет лимит на чат.
+DASHBOARD_INTERVAL = float(os.getenv(
+    "DASHBOARD_INTERVAL", max(METRICS_STREAM_INTERVAL, 1 / TELEGRAM_CHAT_RATE) if METRICS_MODE == "stream" else 10.0
+))
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+# Пул HTTP-соединений к Bot API должен быть не меньше числа одновременно обрабатываемых обновлений и задач.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", 256))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", 5.0))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", 5.0))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", 5.0))
+TELEGRAM_MEDIA_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_WRITE_TIMEOUT", 60.0))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", 5.0))
+SLOW_HANDLER_LIMIT = int(os.getenv("SLOW_HANDLER_LIMIT", 16))  # долгих обработчиков одновременно, не больше
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, который регистрируется в Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+STATS_PORT = int(os.getenv("STATS_PORT", 0))  # 0 — HTTP-эндпоинт метрик выключен
+STATS_BIND = os.getenv("STATS_BIND", "127.0.0.1")
 
 
 # --- Состояния для ConversationHandler ---
@@ -51,6 +131,162 @@ if not logger.handlers:
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
+# --- Инструментирование ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как в Prometheus; квантили оцениваются по корзинам."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (но не больше наблюдавшегося максимума)."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Instrumentation:
+    """Реестр гистограмм и счетчиков с метками; отдается в /stats и в текстовом формате Prometheus."""
+
+    def __init__(self, prefix="tgstatus_"):
+        self.prefix = prefix
+        self.started = time.time()
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.counters = {}    # (имя, метки) -> значение
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        items = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in (*labels, *extra)]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{self.prefix}{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f"{self.prefix}{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{self.prefix}{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def render_text(self) -> str:
+        def label_text(labels):
+            return " ".join(str(v) for _, v in labels)
+
+        lines = ["Время, сек: n / p50 / p95 / max"]
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+            lines.append(f"{name} {label_text(labels)}".rstrip())
+            lines.append(f"  {h.count} / {h.quantile(0.5):.3f} / {h.quantile(0.95):.3f} / {h.max:.3f}")
+        if self.counters:
+            lines.append("")
+            lines.append("Счетчики")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name} {label_text(labels)}: {value}")
+        return "\n".join(lines)
+
+
+instrumentation = Instrumentation()
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API, который замеряет время каждого запроса по методу API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]  # в URL есть токен, в метки попадает только имя метода
+        try:
+            with instrumentation.timer('telegram_request_seconds', method=api_method):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            instrumentation.inc('telegram_request_errors_total', method=api_method)
+            raise
+        if code >= 400:
+            instrumentation.inc('telegram_request_errors_total', method=api_method)
+        return code, payload
+
+def instrumented_handler(label: str, callback):
+    """Оборачивает обработчик обновлений, замеряя полное время его выполнения."""
+    @wraps(callback)
+    async def wrapped(update, context):
+        with instrumentation.timer('handler_seconds', handler=label):
+            return await callback(update, context)
+    return wrapped
+
+slow_handler_slots = asyncio.Semaphore(SLOW_HANDLER_LIMIT)
+
+def bounded_handler(callback):
+    """Обработчик, который выполняется вне очереди обновлений (block=False), но не больше SLOW_HANDLER_LIMIT
+    одновременно: всплеск нажатий не запускает на серверах сколько угодно сканирований сразу."""
+    @wraps(callback)
+    async def wrapped(update, context):
+        queued = time.perf_counter()
+        async with slow_handler_slots:
+            instrumentation.observe('slow_handler_wait_seconds', time.perf_counter() - queued)
+            return await callback(update, context)
+    return wrapped
+
+def record_job_lag(scheduler, event):
+    """Слушатель APScheduler: насколько позже запланированного времени задача JobQueue реально запущена."""
+    aps_job = scheduler.get_job(event.job_id)
+    if aps_job is None or not event.scheduled_run_times:
+        return
+    lag = (datetime.now(timezone.utc) - event.scheduled_run_times[-1]).total_seconds()
+    instrumentation.observe('job_lag_seconds', max(lag, 0.0), job=Job.from_aps_job(aps_job).callback.__name__)
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP-ответ для Prometheus: GET /metrics, остальное — 404."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        if request_line.split()[1:2] == [b"/metrics"]:
+            status, body = "200 OK", instrumentation.render_prometheus().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
 # --- Декоратор для проверки прав ---
 def admin_only(func):
     @wraps(func)
@@ -66,27 +302,1246 @@ def admin_only(func):
         return await func(update, context, *args, **kwargs)
     return wrapped
 
+# --- SSH-соединения ---
+class CommandResult(NamedTuple):
+    stdout: str
+    stderr: str
+    exit_status: int
+
+
+# Блокирующие вызовы paramiko выполняются в отдельных пулах, а не в пуле цикла по умолчанию (min(32, cpu+4) потоков).
+# Подключения висят до таймаута на недоступных хостах, поэтому у них свой пул размером с веер запросов,
+# и они не отнимают потоки у открытия каналов на живых хостах.
+ssh_connect_executor = ThreadPoolExecutor(max_workers=FLEET_PARALLELISM, thread_name_prefix="ssh-connect")
+ssh_channel_executor = ThreadPoolExecutor(max_workers=SSH_CHANNEL_THREADS, thread_name_prefix="ssh-channel")
+
+def run_blocking(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+def _open_exec_channel(transport: paramiko.Transport, command: str, timeout: float) -> paramiko.Channel:
+    channel = transport.open_session(timeout=timeout)
+    channel.exec_command(command)
+    channel.shutdown_write()
+    return channel
+
+async def iter_channel_output(channel: paramiko.Channel, chunk_size=65536):
+    """Отдает порции (stdout, stderr) по мере поступления, ожидая данные через цикл событий, а не в потоке."""
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    fd = channel.fileno()
+    loop.add_reader(fd, readable.set)
+    received = 0
+    try:
+        while True:
+            # Флаг берется до чтения: если EOF уже пришел, все данные канала уже лежат в буферах.
+            finished = channel.eof_received or channel.closed
+            out = channel.recv(chunk_size) if channel.recv_ready() else b""
+            err = channel.recv_stderr(chunk_size) if channel.recv_stderr_ready() else b""
+            if out or err:
+                received += len(out) + len(err)
+                yield out, err
+            elif finished:
+                return
+            else:
+                readable.clear()
+                await readable.wait()
+    finally:
+        loop.remove_reader(fd)
+        instrumentation.inc('ssh_received_bytes_total', received, host=channel.get_name())
+
+class SSHConnection:
+    """Долгоживущее SSH-соединение с хостом: один транспорт, каналы мультиплексируются поверх него."""
+
+    def __init__(self, host, port, username, pkey, max_channels=SSH_MAX_CHANNELS, name=None):
+        self.name = name or host
+        self.host = host
+        self.port = port
+        self.username = username
+        self.pkey = pkey
+        self._client = None
+        self._connect_lock = asyncio.Lock()
+        self._channel_slots = asyncio.Semaphore(max_channels)
+        self._failures = 0
+        self._retry_at = 0.0
+        self._last_error = None
+        self.generation = 0  # растет при каждом новом подключении: после перезагрузки хоста оно всегда новое
+
+    def is_active(self) -> bool:
+        transport = self._client.get_transport() if self._client else None
+        return transport is not None and transport.is_active()
+
+    async def connect(self, timeout=15) -> paramiko.SSHClient:
+        """Возвращает живой клиент, при необходимости переподключаясь с экспоненциальной задержкой."""
+        if self.is_active():
+            return self._client
+        async with self._connect_lock:
+            if self.is_active():
+                return self._client
+            if time.monotonic() < self._retry_at:
+                raise ConnectionError(f"Повторное подключение к {self.name} отложено, последняя ошибка: {self._last_error}")
+            self.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                with instrumentation.timer('ssh_connect_seconds', host=self.name):
+                    await run_blocking(
+                        ssh_connect_executor, client.connect, self.host, port=self.port, username=self.username, pkey=self.pkey, timeout=timeout
+                    )
+            except Exception as e:
+                instrumentation.inc('ssh_connect_failures_total', host=self.name)
+                client.close()
+                self._failures += 1
+                self._last_error = e
+                self._retry_at = time.monotonic() + min(SSH_RECONNECT_MAX_DELAY, 2 ** (self._failures - 1))
+                logger.error(f"SSH connect to {self.name} failed (attempt {self._failures}): {e}")
+                raise
+            client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+            self._client = client
+            self.generation += 1
+            self._failures = 0
+            self._retry_at = 0.0
+            logger.info(f"SSH connection to {self.name} ({self.host}:{self.port}) established.")
+            return client
+
+    async def _open_channel(self, command: str, timeout: float) -> paramiko.Channel:
+        client = await self.connect()
+        try:
+            with instrumentation.timer('ssh_channel_open_seconds', host=self.name):
+                return await run_blocking(ssh_channel_executor, _open_exec_channel, client.get_transport(), command, timeout)
+        except (paramiko.SSHException, EOFError, OSError):
+            if self.is_active():
+                raise
+            # Транспорт умер между keepalive-пакетами: переподключаемся и пробуем еще раз.
+            instrumentation.inc('ssh_channel_retries_total', host=self.name)
+            client = await self.connect()
+            return await run_blocking(ssh_channel_executor, _open_exec_channel, client.get_transport(), command, timeout)
+
+    @asynccontextmanager
+    async def open_channel(self, command: str, timeout=SSH_COMMAND_TIMEOUT, deadline=None):
+        """Занимает слот канала, запускает команду и гарантированно закрывает канал при выходе или отмене.
+
+        Закрытие канала без pty не останавливает команду на сервере: она работает, пока не напишет в закрытый
+        канал, а сканирования, печатающие только в конце, продолжают нагружать хост. pty не подходит (он
+        смешивает stderr со stdout и портит двоичный вывод), поэтому при заданном deadline команда запускается
+        под удаленным timeout и вместе со всей группой процессов завершается сама, чуть позже локального таймаута.
+        """
+        if deadline is not None:
+            command = f"timeout -k 5 {deadline + 5:g} sh -c {shlex.quote(command)}"
+        queued = time.perf_counter()
+        async with self._channel_slots:
+            instrumentation.observe('ssh_channel_wait_seconds', time.perf_counter() - queued, host=self.name)
+            channel = await self._open_channel(command, timeout)
+            channel.set_name(self.name)
+            try:
+                with instrumentation.timer('ssh_command_seconds', host=self.name):
+                    yield channel
+            finally:
+                channel.close()
+
+    async def check(self, timeout=10):
+        """Проверяет, что транспорт жив, выполняя пустую команду в новом канале."""
+        await self.run("true", timeout=timeout)
+
+    async def run(self, command: str, timeout=SSH_COMMAND_TIMEOUT) -> CommandResult:
+        """Выполняет команду с таймаутом; при отмене или таймауте канал закрывается."""
+        async def _run():
+            stdout, stderr = [], []
+            async with self.open_channel(command, timeout, deadline=timeout) as channel:
+                async for out, err in iter_channel_output(channel):
+                    if out: stdout.append(out)
+                    if err: stderr.append(err)
+                if channel.exit_status_ready():
+                    exit_status = channel.exit_status
+                else:
+                    exit_status = await run_blocking(ssh_channel_executor, channel.recv_exit_status)
+            return CommandResult(
+                b"".join(stdout).decode('utf-8', errors='replace'),
+                b"".join(stderr).decode('utf-8', errors='replace'),
+                exit_status,
+            )
+        try:
+            return await asyncio.wait_for(_run(), timeout)
+        except asyncio.TimeoutError:
+            instrumentation.inc('ssh_command_timeouts_total', host=self.name)
+            raise
+
+    def close(self):
+        if self._client:
+            self._client.close()
+            self._client = None
+
+
+# --- Парк серверов ---
+ssh_connections = {}
+hosts = []  # имена хостов в порядке инвентаря
+
+def load_inventory(path=HOSTS_FILE) -> list:
+    """Читает инвентарь из JSON-файла; без файла работаем с одним хостом из переменных окружения."""
+    if not os.path.exists(path):
+        return [{'name': SSH_HOST, 'host': SSH_HOST}]
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def get_ssh_connection(host=None) -> SSHConnection:
+    return ssh_connections[host or hosts[0]]
+
+def selected_host(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Хост, с которым сейчас работает пользователь; по умолчанию первый из инвентаря."""
+    return context.user_data.get('host') or hosts[0]
+
+def is_fleet_view(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    return len(hosts) > 1 and not context.user_data.get('host')
+
+async def fan_out(func, targets=None, limit=FLEET_PARALLELISM) -> dict:
+    """Вызывает func(host) для хостов параллельно, не больше limit одновременно; ошибки возвращаются как значения."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(host):
+        async with semaphore:
+            return await func(host)
+
+    targets = list(targets or hosts)
+    results = await asyncio.gather(*(call(host) for host in targets), return_exceptions=True)
+    return dict(zip(targets, results))
+
 # --- SSH и вспомогательные функции ---
-async def execute_ssh_command(command: str) -> str:
+async def execute_ssh_command(command: str, timeout=SSH_COMMAND_TIMEOUT, host=None) -> str:
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key = paramiko.RSAKey.from_private_key_file(SSH_KEY_PATH)
-        await asyncio.to_thread(
-            ssh.connect, SSH_HOST, port=SSH_PORT, username=SSH_USER, pkey=private_key, timeout=15
-        )
-        stdin, stdout, stderr = ssh.exec_command(command, timeout=30)
-        output = stdout.read().decode('utf-8').strip()
-        error = stderr.read().decode('utf-8').strip()
-        ssh.close()
+        result = await get_ssh_connection(host).run(command, timeout=timeout)
+        output, error = result.stdout.strip(), result.stderr.strip()
         if error:
             logger.error(f"SSH command error for '{command}': {error}")
             return f"Ошибка выполнения команды: {error}"
         return output
+    except asyncio.TimeoutError:
+        logger.error(f"SSH command timed out after {timeout}s: '{command}'")
+        return f"🚨 Ошибка: команда не завершилась за {timeout:g} сек."
     except Exception as e:
         logger.error(f"SSH connection or command failed: {e}")
         return f"🚨 Не удалось подключиться к серверу или выполнить команду. Ошибка: {e}"
 
+async def download_command_output(command: str, file, limit: int, timeout=SSH_COMMAND_TIMEOUT, host=None, progress=None):
+    """Пишет stdout команды в файл по мере поступления, не накапливая его в памяти; читает не больше limit байт.
+
+    progress, если задан, вызывается с числом уже записанных байт после каждой порции.
+
+    Возвращает (записано байт, stderr, достигнут ли лимит).
+    """
+    errors = bytearray()
+    written = 0
+
+    async def _download():
+        nonlocal written
+        async with get_ssh_connection(host).open_channel(command, deadline=timeout) as channel:
+            async with aclosing(iter_channel_output(channel)) as chunks:
+                async for out, err in chunks:
+                    if err and len(errors) < 4096:
+                        errors.extend(err)
+                    if out:
+                        out = out[:limit - written]
+                        file.write(out)
+                        written += len(out)
+                        if progress:
+                            progress(written)
+                        if written >= limit:
+                            return
+
+    await asyncio.wait_for(_download(), timeout)
+    return written, errors.decode('utf-8', errors='replace').strip(), written >= limit
+
+# --- Метрики сервера ---
+# Один удаленный вызов: только чтение /proc и statfs, без top/free/df.
+METRICS_COMMAND = "; ".join([
+    "awk '/^cpu /{printf \"cpu_total=%.0f\\ncpu_idle=%.0f\\n\", $2+$3+$4+$5+$6+$7+$8+$9, $5+$6} /^cpu[0-9]/{n++} END{print \"cpu_count=\" n}' /proc/stat",
+    "awk '/^(MemTotal|MemAvailable|SwapTotal|SwapFree):/{sub(\":\", \"\", $1); printf \"%s=%.0f\\n\", $1, $2*1024}' /proc/meminfo",
+    "awk '{print \"load1=\" $1 \"\\nload5=\" $2 \"\\nload15=\" $3}' /proc/loadavg",
+    "awk '{print \"uptime=\" $1}' /proc/uptime",
+    "awk 'NR>2{sub(\":\", \" \"); if ($1 != \"lo\") {rx+=$2; tx+=$10}} END{printf \"net_rx=%.0f\\nnet_tx=%.0f\\n\", rx, tx}' /proc/net/dev",
+    "stat -f -c '%b %f %a %S' / | awk '{printf \"disk_total=%.0f\\ndisk_used=%.0f\\ndisk_avail=%.0f\\n\", $1*$4, ($1-$2)*$4, $3*$4}'",
+])
+
+def parse_key_values(output: str) -> dict:
+    values = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            values[key.strip()] = value.strip()
+    return values
+
+def parse_metric_values(output: str, errors: str = "") -> dict:
+    values = parse_key_values(output)
+    if 'cpu_total' not in values or 'MemTotal' not in values:
+        raise RuntimeError(f"Unexpected metrics output: {errors.strip() or output.strip()}")
+    return {key: float(value) for key, value in values.items() if value}
+
+def _percent(part, whole):
+    return part / whole * 100 if whole > 0 else 0.0
+
+class MetricsCollector:
+    """Собирает метрики хоста за один SSH-вызов; CPU% и скорость сети считаются по дельтам счетчиков."""
+
+    def __init__(self, connection: SSHConnection):
+        self.connection = connection
+        self._previous = None
+
+    async def _fetch(self) -> dict:
+        result = await self.connection.run(METRICS_COMMAND)
+        return parse_metric_values(result.stdout, result.stderr)
+
+    async def collect(self) -> dict:
+        snapshot = self.update(await self._fetch())
+        if snapshot is None:
+            # Для первой дельты нужен второй замер.
+            await asyncio.sleep(0.5)
+            snapshot = self.update(await self._fetch())
+        return snapshot
+
+    def update(self, values: dict):
+        """Считает снимок по сырым счетчикам относительно предыдущего замера; для первого замера вернет None."""
+        previous, self._previous = self._previous, values
+        if previous is None:
+            return None
+
+        cpu_total = values['cpu_total'] - previous['cpu_total']
+        cpu_idle = values['cpu_idle'] - previous['cpu_idle']
+        elapsed = values['uptime'] - previous['uptime']
+        if cpu_total <= 0 or elapsed <= 0:
+            # Счетчики сбросились (перезагрузка): берем средние значения с момента загрузки.
+            cpu_total, cpu_idle, elapsed = values['cpu_total'], values['cpu_idle'], 0
+        mem_used = values['MemTotal'] - values.get('MemAvailable', 0)
+        swap_used = values.get('SwapTotal', 0) - values.get('SwapFree', 0)
+        return {
+            'timestamp': time.time(),
+            'cpu': _percent(cpu_total - cpu_idle, cpu_total),
+            'cpu_count': int(values.get('cpu_count', 1)),
+            'load1': values['load1'],
+            'load5': values['load5'],
+            'load15': values['load15'],
+            'ram': _percent(mem_used, values['MemTotal']),
+            'ram_used': mem_used,
+            'ram_total': values['MemTotal'],
+            'swap': _percent(swap_used, values.get('SwapTotal', 0)),
+            'swap_used': swap_used,
+            'swap_total': values.get('SwapTotal', 0),
+            'disk': _percent(values['disk_used'], values['disk_used'] + values['disk_avail']),
+            'disk_used': values['disk_used'],
+            'disk_total': values['disk_total'],
+            'net_rx': max(values['net_rx'] - previous['net_rx'], 0) / elapsed if elapsed else 0.0,
+            'net_tx': max(values['net_tx'] - previous['net_tx'], 0) / elapsed if elapsed else 0.0,
+            'uptime': values['uptime'],
+        }
+
+
+class MetricsSampler:
+    """Публикует последний снимок метрик хоста; одновременные промахи кэша сводятся к одному запросу."""
+
+    def __init__(self, collector: MetricsCollector):
+        self.collector = collector
+        self.snapshot = None
+        self._inflight = None
+        self._subscribers = set()
+
+    def publish(self, snapshot: dict):
+        self.snapshot = snapshot
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()  # медленный подписчик теряет самый старый снимок, а не тормозит остальных
+            queue.put_nowait(snapshot)
+
+    async def subscribe(self, backlog=64):
+        """Асинхронный поток снимков: каждый новый снимок, опубликованный опросом или стримом."""
+        queue = asyncio.Queue(maxsize=backlog)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers.discard(queue)
+
+    def is_fresh(self, max_age: float) -> bool:
+        return self.snapshot is not None and time.time() - self.snapshot['timestamp'] <= max_age
+
+    async def get(self, max_age=METRICS_CACHE_TTL) -> dict:
+        """Возвращает снимок не старше max_age секунд, при необходимости обновляя его."""
+        if self.is_fresh(max_age):
+            return self.snapshot
+        return await self.refresh()
+
+    async def refresh(self) -> dict:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._collect())
+            self._inflight.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # shield: отмена одного ожидающего не должна прерывать общий запрос.
+        return await asyncio.shield(self._inflight)
+
+    async def _collect(self) -> dict:
+        try:
+            snapshot = await self.collector.collect()
+            self.publish(snapshot)
+            return snapshot
+        finally:
+            self._inflight = None
+
+
+# Цикл на удаленной стороне: /proc читается встроенными командами shell, диск (statfs) — раз в 10 замеров.
+METRICS_STREAM_SCRIPT = """
+cpus=$(grep -c '^cpu[0-9]' /proc/stat); n=0
+while :; do
+  read -r _ u ni sy id io irq sirq st _ < /proc/stat
+  echo "cpu_total=$((u+ni+sy+id+io+irq+sirq+st))"; echo "cpu_idle=$((id+io))"; echo "cpu_count=$cpus"
+  while read -r k v _; do case $k in MemTotal:|MemAvailable:|SwapTotal:|SwapFree:) echo "${k%:}=$((v*1024))";; esac; done < /proc/meminfo
+  read -r l1 l5 l15 _ < /proc/loadavg; echo "load1=$l1"; echo "load5=$l5"; echo "load15=$l15"
+  read -r up _ < /proc/uptime; echo "uptime=$up"
+  rx=0; tx=0
+  while IFS=: read -r iface data; do
+    iface=${iface##* }; [ -n "$data" ] && [ "$iface" != lo ] || continue
+    set -- $data; rx=$((rx+$1)); tx=$((tx+$9))
+  done < /proc/net/dev
+  echo "net_rx=$rx"; echo "net_tx=$tx"
+  if [ $((n % 10)) -eq 0 ]; then
+    set -- $(stat -f -c '%b %f %a %S' /)
+    disk="disk_total=$(($1*$4)) disk_used=$((($1-$2)*$4)) disk_avail=$(($3*$4))"
+  fi
+  for kv in $disk; do echo "$kv"; done
+  echo --; n=$((n+1)); sleep {interval}
+done
+"""
+
+class TelemetryStream:
+    """Держит на хосте цикл сэмплирования в одном постоянном канале и публикует снимки в сэмплер."""
+
+    def __init__(self, sampler: MetricsSampler, interval=METRICS_STREAM_INTERVAL, stall_timeout=METRICS_STREAM_STALL_TIMEOUT):
+        self.sampler = sampler
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.restarts = 0
+
+    async def samples(self):
+        """Асинхронный генератор снимков, разбираемых из канала построчно по мере поступления."""
+        collector = self.sampler.collector
+        command = "sh -c " + shlex.quote(METRICS_STREAM_SCRIPT.replace("{interval}", f"{self.interval:g}"))
+        # Без deadline: цикл пишет в канал каждую секунду и после закрытия канала сразу гибнет от SIGPIPE.
+        async with collector.connection.open_channel(command) as channel:
+            buffer, block = b"", []
+            async with aclosing(iter_channel_output(channel)) as chunks:
+                async for out, err in chunks:
+                    if err:
+                        logger.warning(f"Telemetry stream stderr from {collector.connection.name}: {err.decode(errors='replace').strip()}")
+                    *lines, buffer = (buffer + out).split(b"\n")
+                    for line in lines:
+                        if line != b"--":
+                            block.append(line.decode(errors='replace'))
+                            continue
+                        snapshot = collector.update(parse_metric_values("\n".join(block)))
+                        block = []
+                        if snapshot is not None:
+                            yield snapshot
+        raise ConnectionError("telemetry channel closed")
+
+    async def run(self):
+        """Публикует снимки, перезапуская стрим, если он оборвался или замолчал дольше stall_timeout."""
+        host = self.sampler.collector.connection.name
+        failures = 0
+        while True:
+            try:
+                async with aclosing(self.samples()) as samples:
+                    while True:
+                        self.sampler.publish(await asyncio.wait_for(samples.__anext__(), self.stall_timeout))
+                        failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.restarts += 1
+                logger.warning(f"Telemetry stream for {host} stalled or failed ({e!r}), restarting.")
+                await asyncio.sleep(min(SSH_RECONNECT_MAX_DELAY, 2 ** (failures - 1)))
+
+
+# --- Кэш фактов о хосте ---
+class Fact(NamedTuple):
+    command: str
+    lifetime: str  # boot — до перезагрузки, ttl — ttl секунд
+    ttl: float = 0.0
+
+
+# Живые метрики сюда не входят: они всегда берутся из MetricsSampler.
+FACTS = {
+    'boot_id': Fact("cat /proc/sys/kernel/random/boot_id", 'boot'),
+    'os_name': Fact("awk -F= '$1 == \"PRETTY_NAME\" {gsub(/\"/, \"\", $2); print $2}' /etc/os-release", 'boot'),
+    'hostname': Fact("hostname", 'boot'),
+    'cpu_model': Fact("grep -m 1 'model name' /proc/cpuinfo | cut -d: -f2 | sed 's/^ *//'", 'boot'),
+    'listening': Fact("ss -tulnp", 'ttl', FACT_SLOW_TTL),
+}
+FACT_MARKER = "@@fact "
+BOOT_TIME_TOLERANCE = 60  # сек расхождения оценки времени загрузки, которые списываются на дрейф часов
+
+class FactCache:
+    """Факты о хосте с разным временем жизни; с сервера запрашиваются только устаревшие поля, одним вызовом.
+
+    Факты класса boot сбрасываются при смене boot_id или скачке времени загрузки, вычисленного по uptime из
+    снимков метрик; boot_id перепроверяется после каждого переподключения SSH.
+    """
+
+    def __init__(self, connection: SSHConnection, sampler: MetricsSampler):
+        self.connection = connection
+        self.sampler = sampler
+        self.values = {}  # имя -> (значение, time.monotonic() получения)
+        self._boot_time = None
+        self._generation = None
+        self._lock = asyncio.Lock()
+
+    def is_stale(self, name: str, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        if name not in self.values:
+            return True
+        fact = FACTS[name]
+        return fact.lifetime == 'ttl' and now - self.values[name][1] > fact.ttl
+
+    def _invalidate_boot(self, reason: str):
+        if any(FACTS[name].lifetime == 'boot' for name in self.values):
+            logger.info(f"Boot-static facts for {self.connection.name} invalidated: {reason}.")
+            instrumentation.inc('fact_cache_invalidations_total', host=self.connection.name)
+        self.values = {name: value for name, value in self.values.items() if FACTS[name].lifetime != 'boot'}
+
+    def _check_uptime(self):
+        snapshot = self.sampler.snapshot
+        if snapshot is None:
+            return
+        boot_time = snapshot['timestamp'] - snapshot['uptime']
+        if self._boot_time is not None and abs(boot_time - self._boot_time) > BOOT_TIME_TOLERANCE:
+            self._invalidate_boot("uptime reset")
+        self._boot_time = boot_time
+
+    async def _fetch(self, names: list):
+        command = "; ".join(f"echo '{FACT_MARKER}{name}'; {{ {FACTS[name].command}; }} 2>&1" for name in names)
+        result = await self.connection.run(command)
+        now, name, lines = time.monotonic(), None, []
+        for line in result.stdout.splitlines() + [FACT_MARKER]:
+            if line.startswith(FACT_MARKER):
+                if name is not None:
+                    self.values[name] = ("\n".join(lines).strip(), now)
+                name, lines = line[len(FACT_MARKER):] or None, []
+            else:
+                lines.append(line)
+
+    async def get(self, *names, fresh=False) -> dict:
+        """Значения фактов names; fresh=True принудительно перечитывает их с сервера."""
+        async with self._lock:
+            self._check_uptime()
+            now = time.monotonic()
+            stale = [name for name in names if fresh or self.is_stale(name, now)]
+            instrumentation.inc('fact_cache_hits_total', len(set(names) - set(stale)), host=self.connection.name)
+            instrumentation.inc('fact_cache_misses_total', len(set(names) & set(stale)), host=self.connection.name)
+            reconnected = self._generation != self.connection.generation
+            if 'boot_id' not in stale and ('boot_id' not in self.values or reconnected) and (stale or reconnected):
+                # boot_id дешево сверить в том же вызове: новое SSH-соединение могло появиться после перезагрузки.
+                stale.append('boot_id')
+            if stale:
+                previous_boot_id = self.values.get('boot_id', (None,))[0]
+                await self._fetch(stale)
+                self._generation = self.connection.generation
+                if previous_boot_id is not None and self.values['boot_id'][0] != previous_boot_id:
+                    boot_id = self.values.pop('boot_id')
+                    self._invalidate_boot("boot_id changed")
+                    self.values['boot_id'] = boot_id
+                    missing = [name for name in names if name not in self.values]
+                    if missing:
+                        await self._fetch(missing)
+            return {name: self.values[name][0] for name in names}
+
+    def age(self, name: str) -> float:
+        return time.monotonic() - self.values[name][1] if name in self.values else 0.0
+
+    def describe(self) -> list:
+        """Строки для /cache: класс времени жизни и возраст каждого закэшированного факта."""
+        now = time.monotonic()
+        return [f"{name:<10} {FACTS[name].lifetime:<4} {int(now - fetched)} сек" for name, (_, fetched) in sorted(self.values.items())]
+
+
+metrics_samplers = {}
+telemetry_streams = {}
+fact_caches = {}
+background_tasks = []
+
+def get_metrics_sampler(host=None) -> MetricsSampler:
+    return metrics_samplers[host or hosts[0]]
+
+def init_ssh_connections():
+    """Загружает ключи один раз при старте и создает соединения и сэмплеры для хостов инвентаря."""
+    keys = {}
+    for entry in load_inventory():
+        name = entry.get('name') or entry['host']
+        key_path = entry.get('key_path', SSH_KEY_PATH)
+        if key_path not in keys:
+            keys[key_path] = paramiko.RSAKey.from_private_key_file(key_path)
+        ssh_connections[name] = SSHConnection(
+            entry['host'], int(entry.get('port', SSH_PORT)), entry.get('user', SSH_USER), keys[key_path], name=name
+        )
+        metrics_samplers[name] = MetricsSampler(MetricsCollector(ssh_connections[name]))
+        fact_caches[name] = FactCache(ssh_connections[name], metrics_samplers[name])
+        if METRICS_MODE == "stream":
+            telemetry_streams[name] = TelemetryStream(metrics_samplers[name])
+        hosts.append(name)
+    logger.info(f"Loaded {len(hosts)} host(s) from inventory.")
+
+async def start_background_tasks(application: Application):
+    telegram_output.bot = application.bot
+    scheduler = application.job_queue.scheduler
+    scheduler.add_listener(lambda event: record_job_lag(scheduler, event), EVENT_JOB_SUBMITTED)
+    if STATS_PORT:
+        metrics_server = await asyncio.start_server(serve_metrics, STATS_BIND, STATS_PORT)
+        background_tasks.append(asyncio.create_task(metrics_server.serve_forever()))
+        logger.info(f"Prometheus metrics endpoint listening on {STATS_BIND}:{STATS_PORT}.")
+    background_tasks.append(asyncio.create_task(telegram_output.run()))
+    for host, sampler in metrics_samplers.items():
+        background_tasks.append(asyncio.create_task(record_history(host, sampler)))
+        background_tasks.append(asyncio.create_task(evaluate_alerts(host, sampler)))
+    for stream in telemetry_streams.values():
+        background_tasks.append(asyncio.create_task(stream.run()))
+
+async def stop_background_tasks(application: Application):
+    task_manager.cancel_all()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    for connection in ssh_connections.values():
+        connection.close()
+    for executor in (ssh_connect_executor, ssh_channel_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
+    history_store.close()
+
+def format_bytes(value: float) -> str:
+    for unit in ("B", "K", "M", "G", "T"):
+        if abs(value) < 1024 or unit == "T":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+
+def format_uptime(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    parts = [f"{value} {unit}{'s' if value != 1 else ''}" for value, unit in ((days, "day"), (hours, "hour"), (minutes, "minute")) if value]
+    return "up " + ", ".join(parts or ["0 minutes"])
+
+def format_bar(percent: float) -> str:
+    filled = min(int(percent / 10), 10)
+    return f"[{'█' * filled + '─' * (10 - filled)}] {percent:.1f}%"
+
+def rank_fleet(snapshots: dict) -> list:
+    """Сортирует хосты от худшего к лучшему: сначала недоступные, затем по максимальной загрузке ресурса."""
+    def severity(item):
+        snapshot = item[1]
+        if isinstance(snapshot, BaseException):
+            return (1, 0.0)
+        return (0, max(snapshot['cpu'], snapshot['ram'], snapshot['disk']))
+    return sorted(snapshots.items(), key=severity, reverse=True)
+
+def render_fleet(ranked: list, limit=FLEET_WORST_COUNT) -> str:
+    healthy = [snapshot for _, snapshot in ranked if not isinstance(snapshot, BaseException)]
+    lines = [f"В сети: {len(healthy)}/{len(ranked)}"]
+    if healthy:
+        lines.append(f"Средн.: CPU {sum(s['cpu'] for s in healthy) / len(healthy):.0f}% · "
+                     f"RAM {sum(s['ram'] for s in healthy) / len(healthy):.0f}%")
+    lines.append("")
+    for host, snapshot in ranked[:limit]:
+        if isinstance(snapshot, BaseException):
+            lines.append(f"{host[:16]:<16} ❌ недоступен")
+        else:
+            lines.append(f"{host[:16]:<16} CPU {snapshot['cpu']:3.0f}% RAM {snapshot['ram']:3.0f}% Disk {snapshot['disk']:3.0f}%")
+    return "\n".join(lines)
+
+async def collect_fleet(max_age=METRICS_CACHE_TTL) -> list:
+    return rank_fleet(await fan_out(lambda host: metrics_samplers[host].get(max_age)))
+
+# --- История метрик ---
+# (разрешение в секундах, число слотов): сырые значения за час, минутные агрегаты за сутки, 10-минутные за месяц.
+HISTORY_TIERS = ((1, 3600), (60, 24 * 60), (600, 30 * 24 * 6))
+HISTORY_METRICS = {'cpu': "CPU", 'ram': "RAM", 'swap': "Swap", 'disk': "Disk", 'load1': "Load", 'net_rx': "Net ↓", 'net_tx': "Net ↑"}
+HISTORY_PERIODS = {'1h': 3600, '24h': 24 * 3600, '7d': 7 * 24 * 3600, '30d': 30 * 24 * 3600}
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+SLOT_WIDTH = 4  # начало интервала, число значений, сумма, максимум
+
+class TimeSeries:
+    """Ступенчатые кольцевые буферы одной метрики в memory-mapped файле из float64."""
+
+    def __init__(self, path: str, tiers=HISTORY_TIERS):
+        self.tiers = tiers
+        self._offsets = []
+        size = 0
+        for _, capacity in tiers:
+            self._offsets.append(size)
+            size += capacity * SLOT_WIDTH
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size * 8:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size * 8)
+            self._mmap = mmap.mmap(fd, size * 8)
+        finally:
+            os.close(fd)
+        self._data = memoryview(self._mmap).cast('d')
+
+    def add(self, timestamp: float, value: float):
+        """Кладет значение во все уровни; агрегаты обновляются на месте, слот переиспользуется по кругу."""
+        data = self._data
+        for (resolution, capacity), offset in zip(self.tiers, self._offsets):
+            bucket = int(timestamp // resolution)
+            i = offset + bucket % capacity * SLOT_WIDTH
+            if data[i] != bucket * resolution:
+                data[i], data[i + 1], data[i + 2], data[i + 3] = bucket * resolution, 1, value, value
+            else:
+                data[i + 1] += 1
+                data[i + 2] += value
+                data[i + 3] = max(data[i + 3], value)
+
+    def points(self, since: float, until: float = None) -> list:
+        """Возвращает [(время, среднее, максимум)] из самого подробного уровня, покрывающего период."""
+        until = until or time.time()
+        for (resolution, capacity), offset in zip(self.tiers, self._offsets):
+            if until - since <= resolution * (capacity + 1):
+                break
+        data = self._data
+        result = []
+        for bucket in range(int(since // resolution), int(until // resolution) + 1):
+            i = offset + bucket % capacity * SLOT_WIDTH
+            if data[i] == bucket * resolution and data[i + 1]:
+                result.append((data[i], data[i + 2] / data[i + 1], data[i + 3]))
+        return result
+
+    def close(self):
+        self._data.release()
+        self._mmap.close()
+
+
+class HistoryStore:
+    """Хранилище временных рядов по хостам и метрикам; файлы лежат в HISTORY_DIR."""
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._series = {}
+
+    def series(self, host: str, metric: str) -> TimeSeries:
+        key = (host, metric)
+        if key not in self._series:
+            os.makedirs(self.directory, exist_ok=True)
+            safe_host = re.sub(r'[^\w.-]', '_', host)
+            self._series[key] = TimeSeries(os.path.join(self.directory, f"{safe_host}.{metric}.ts"))
+        return self._series[key]
+
+    def record(self, host: str, snapshot: dict):
+        for metric in HISTORY_METRICS:
+            if metric in snapshot:
+                self.series(host, metric).add(snapshot['timestamp'], snapshot[metric])
+
+    def close(self):
+        for series in self._series.values():
+            series.close()
+        self._series.clear()
+
+
+history_store = HistoryStore()
+
+async def record_history(host: str, sampler: MetricsSampler):
+    async for snapshot in sampler.subscribe():
+        history_store.record(host, snapshot)
+
+def render_sparkline(values: list, width=24) -> str:
+    if not values:
+        return ""
+    # Сжимаем ряд до width колонок усреднением.
+    step = max(len(values) / width, 1)
+    columns = []
+    for n in range(min(width, len(values))):
+        chunk = values[int(n * step):int((n + 1) * step)] or values[-1:]
+        columns.append(sum(chunk) / len(chunk))
+    low, high = min(columns), max(columns)
+    scale = (len(SPARK_CHARS) - 1) / (high - low) if high > low else 0
+    return "".join(SPARK_CHARS[int((value - low) * scale)] for value in columns)
+
+def format_metric_value(metric: str, value: float) -> str:
+    if metric.startswith('net_'):
+        return f"{format_bytes(value)}/s"
+    if metric.startswith('load'):
+        return f"{value:.2f}"
+    return f"{value:.0f}%"
+
+def render_history(host: str, period: str) -> str:
+    since = time.time() - HISTORY_PERIODS[period]
+    lines = []
+    for metric, label in HISTORY_METRICS.items():
+        points = history_store.series(host, metric).points(since)
+        if not points:
+            lines.append(f"{label:<6} нет данных")
+            continue
+        means = [mean for _, mean, _ in points]
+        peak = max(peak for _, _, peak in points)
+        lines.append(f"{label:<6} {render_sparkline(means)}")
+        lines.append(f"       ср {format_metric_value(metric, sum(means) / len(means))}"
+                     f" · макс {format_metric_value(metric, peak)} · сейчас {format_metric_value(metric, means[-1])}")
+    return "\n".join(lines)
+
+# --- Отправка в Telegram ---
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity; blocked_until задает принудительную паузу."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.blocked_until = 0.0
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def ready_at(self, now: float) -> float:
+        self._refill(now)
+        ready = now if self._tokens >= 1 else now + (1 - self._tokens) / self.rate
+        return max(ready, self.blocked_until)
+
+    def take(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class TelegramOutput:
+    """Слой между обработчиками и context.bot: дедупликация и склейка правок, лимиты Bot API и RetryAfter."""
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, max_tracked=1000):
+        self.bot = None
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chats = {}
+        self._pending = {}   # (chat_id, message_id) -> параметры последней запрошенной правки
+        self._rendered = {}  # (chat_id, message_id) -> то, что уже показано в сообщении
+        self._dead = set()
+        self._delivering = {}  # chat_id -> задача с правкой, которая сейчас отправляется
+        self._max_tracked = max_tracked
+        self._wakeup = asyncio.Event()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        chat_id = int(chat_id)  # ADMIN_USER_ID приходит строкой, а chat_id из обновлений — числом
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket(self._chat_rate, 1)
+        return self._chats[chat_id]
+
+    def edit(self, chat_id, message_id, text, reply_markup=None, parse_mode=None):
+        """Ставит правку живого сообщения в очередь; неизмененный текст не отправляется, новые правки вытесняют старые."""
+        key = (int(chat_id), message_id)
+        rendered = (text, parse_mode, reply_markup.to_json() if reply_markup else None)
+        if self._rendered.get(key) == rendered:
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = {'text': text, 'reply_markup': reply_markup, 'parse_mode': parse_mode, 'rendered': rendered}
+        self._wakeup.set()
+
+    def is_dead(self, chat_id, message_id) -> bool:
+        return (int(chat_id), message_id) in self._dead
+
+    def forget(self, chat_id, message_id):
+        key = (int(chat_id), message_id)
+        self._pending.pop(key, None)
+        self._rendered.pop(key, None)
+        self._dead.discard(key)
+
+    async def _acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id)
+            delay = max(bucket.ready_at(now), self._global.ready_at(now)) - now
+            if delay <= 0:
+                bucket.take(now)
+                self._global.take(now)
+                return
+            await asyncio.sleep(delay)
+
+    def _retry_after(self, chat_id, error: RetryAfter):
+        delay = error.retry_after.total_seconds() if hasattr(error.retry_after, 'total_seconds') else error.retry_after
+        instrumentation.inc('telegram_retry_after_total')
+        logger.warning(f"Telegram flood control for chat {chat_id}: retry after {delay}s.")
+        self._chat_bucket(chat_id).blocked_until = time.monotonic() + delay
+
+    async def send_message(self, chat_id, text, attempts=3, **kwargs):
+        """Отправляет сообщение с учетом лимитов; при RetryAfter ждет указанное время и повторяет."""
+        for attempt in range(attempts):
+            await self._acquire(chat_id)
+            try:
+                return await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                self._retry_after(chat_id, e)
+                if attempt == attempts - 1:
+                    raise
+
+    async def run(self):
+        """Фоновый цикл отправки правок: чат, который раньше всех освободится, обслуживается первым.
+
+        Правки разных чатов отправляются параллельно (в пределах общего лимита), так что медленный запрос
+        в одном чате не задерживает остальные; в пределах чата правки идут строго по одной.
+        """
+        try:
+            while True:
+                await self._dispatch()
+        finally:
+            for task in self._delivering.values():
+                task.cancel()
+
+    async def _dispatch(self):
+        """Дожидается правки, которую можно отправить по лимитам, и запускает ее отправку."""
+        while True:
+            ready = [key for key in self._pending if key[0] not in self._delivering]
+            if not ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            key = min(ready, key=lambda k: self._chat_bucket(k[0]).ready_at(now))
+            delay = max(self._chat_bucket(key[0]).ready_at(now), self._global.ready_at(now)) - now
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            request = self._pending.pop(key)
+            self._chat_bucket(key[0]).take(now)
+            self._global.take(now)
+            task = asyncio.create_task(self._deliver(key, request))
+            self._delivering[key[0]] = task
+            task.add_done_callback(lambda _, chat_id=key[0]: self._delivered(chat_id))
+            return
+
+    def _delivered(self, chat_id):
+        self._delivering.pop(chat_id, None)
+        self._wakeup.set()
+
+    async def _deliver(self, key, request):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id, text=request['text'],
+                reply_markup=request['reply_markup'], parse_mode=request['parse_mode']
+            )
+        except RetryAfter as e:
+            self._retry_after(chat_id, e)
+            self._pending.setdefault(key, request)  # более свежая правка, если появилась, важнее
+            return
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                logger.error(f"Live message {key} can no longer be edited: {e}")
+                self._dead.add(key)
+                return
+        except Exception as e:
+            logger.error(f"Live message {key} update failed, will retry: {e}")
+            instrumentation.inc('telegram_edit_retries_total')
+            self._pending.setdefault(key, request)
+            return
+        self._rendered[key] = request['rendered']
+        while len(self._rendered) > self._max_tracked:
+            self._rendered.pop(next(iter(self._rendered)))
+
+
+telegram_output = TelegramOutput()
+
+# --- Долгие операции ---
+class TaskResult(NamedTuple):
+    text: str
+    parse_mode: str = None
+    reply_markup: InlineKeyboardMarkup = None
+    document: object = None  # файл для первой отправки, после нее — file_id из Telegram
+    filename: str = None
+
+
+class Task:
+    """Долгая операция в фоне: прогресс, отмена и сообщения, в которых показывается ее состояние."""
+
+    def __init__(self, task_id: str, key: tuple, title: str, cache=True):
+        self.id = task_id
+        self.key = key
+        self.title = title
+        self.cache = cache
+        self.progress = ""
+        self.started = time.monotonic()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.watchers = []  # (chat_id, message_id)
+        self._task = None
+
+    def report(self, progress: str):
+        self.progress = progress
+        task_manager.render_progress(self)
+
+
+class TaskManager:
+    """Запускает долгие операции в фоне: одинаковые запросы присоединяются к уже идущей операции,
+    успешные результаты хранятся result_ttl секунд и отдаются сразу."""
+
+    def __init__(self, result_ttl=TASK_RESULT_TTL, progress_interval=TASK_PROGRESS_INTERVAL):
+        self.result_ttl = result_ttl
+        self.progress_interval = progress_interval
+        self.tasks = {}    # id -> Task
+        self._by_key = {}  # ключ дедупликации -> Task
+        self._next_id = 0
+
+    def _expire(self):
+        now = time.monotonic()
+        for task in list(self._by_key.values()):
+            if task.finished is not None and now - task.finished > self.result_ttl:
+                self._forget(task)
+                self._release(task)
+
+    def _forget(self, task: Task):
+        self.tasks.pop(task.id, None)
+        if self._by_key.get(task.key) is task:
+            del self._by_key[task.key]
+
+    @staticmethod
+    def _release(task: Task):
+        """Закрывает файл результата, который так и не был загружен в Telegram."""
+        if task.result is not None and task.result.document is not None and not isinstance(task.result.document, str):
+            task.result.document.close()
+
+    def active(self) -> list:
+        return [task for task in self.tasks.values() if task.finished is None]
+
+    async def submit(self, key: tuple, title: str, func, chat_id, message_id, fresh=False, cache=True) -> Task:
+        """Показывает в сообщении ход операции key, запуская ее только если она не идет и нет свежего результата.
+
+        cache=False — результат не переиспользуется (для команд с побочными эффектами), объединяются только
+        одновременные запросы.
+        """
+        self._expire()
+        task = self._by_key.get(key)
+        if task is not None and fresh and task.finished is not None:
+            self._forget(task)
+            self._release(task)
+            task = None
+        if task is None:
+            self._next_id += 1
+            task = Task(str(self._next_id), key, title, cache)
+            self.tasks[task.id] = task
+            self._by_key[key] = task
+            task._task = asyncio.create_task(self._run(task, func))
+        if task.finished is None:
+            if (chat_id, message_id) not in task.watchers:
+                task.watchers.append((chat_id, message_id))
+            self.render_progress(task)
+        else:
+            await self._deliver(task, chat_id, message_id)
+        return task
+
+    def cancel(self, task_id: str) -> bool:
+        task = self.tasks.get(task_id)
+        if task is None or task.finished is not None:
+            return False
+        task._task.cancel()
+        return True
+
+    def cancel_all(self):
+        for task in self.active():
+            task._task.cancel()
+
+    def render_progress(self, task: Task):
+        elapsed = int(time.monotonic() - task.started)
+        text = f"⏳ {task.title}\n{task.progress}\n\nИдет {elapsed} сек"
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Отменить", callback_data=f'task_cancel:{task.id}')]])
+        for chat_id, message_id in task.watchers:
+            telegram_output.edit(chat_id, message_id, text, reply_markup=keyboard)
+
+    async def _tick(self, task: Task):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.render_progress(task)
+
+    async def _run(self, task: Task, func):
+        ticker = asyncio.create_task(self._tick(task))
+        try:
+            task.result = await func(task)
+        except asyncio.CancelledError:
+            task.error = "отменено"
+        except Exception as e:
+            logger.error(f"Task {task.id} ({task.title}) failed: {e!r}")
+            task.error = e
+        finally:
+            ticker.cancel()
+            task.finished = time.monotonic()
+        if task.error is not None or not task.cache:
+            self._forget(task)  # ошибки и отмены не кэшируются
+        for chat_id, message_id in task.watchers:
+            await self._deliver(task, chat_id, message_id)
+        task.watchers.clear()
+        if task.id not in self.tasks:
+            self._release(task)  # результат не кэшируется, и больше его никто не получит
+
+    async def _deliver(self, task: Task, chat_id, message_id):
+        if task.error is not None:
+            icon = "✖️" if task.error == "отменено" else "❌"
+            telegram_output.edit(chat_id, message_id, f"{icon} {task.title}: {task.error}", reply_markup=get_back_keyboard())
+            return
+        result = task.result
+        text = result.text
+        age = int(time.monotonic() - task.finished)
+        if age > 0:
+            text += f"\n\n🕒 Результат получен {age} сек назад"
+        if result.document is None:
+            telegram_output.edit(chat_id, message_id, text, reply_markup=result.reply_markup, parse_mode=result.parse_mode)
+            return
+        try:
+            message = await telegram_output.bot.send_document(
+                chat_id=chat_id, document=result.document, filename=result.filename, caption=text, parse_mode=result.parse_mode
+            )
+        except Exception as e:
+            logger.error(f"Task {task.id} result delivery failed: {e!r}")
+            telegram_output.edit(chat_id, message_id, f"❌ {task.title}: не удалось отправить результат: {e}")
+            if not isinstance(result.document, str) and not result.document.closed:
+                result.document.seek(0)  # файл мог быть прочитан частично; следующий получатель загрузит его заново
+            return
+        if not isinstance(result.document, str):
+            # Файл уже загружен в Telegram: повторные запросы отправляют его по file_id без новой загрузки.
+            result.document.close()
+            task.result = result._replace(document=message.document.file_id)
+        telegram_output.forget(chat_id, message_id)
+        try:
+            await telegram_output.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except BadRequest:
+            pass
+
+
+task_manager = TaskManager()
+
+# --- Оповещения ---
+class AlertRule(NamedTuple):
+    metric: str
+    label: str
+    threshold: float
+    duration: float = ALERT_DURATION
+    hysteresis: float = ALERT_HYSTERESIS
+
+
+ALERT_RULES = [
+    AlertRule('cpu', "Нагрузка CPU", CPU_THRESHOLD),
+    AlertRule('ram', "Использование RAM", RAM_THRESHOLD),
+    AlertRule('disk', "Место на диске", DISK_THRESHOLD),
+]
+
+class RollingWindow:
+    """Значения за последние duration секунд с инкрементальными суммой, минимумом и максимумом.
+
+    Окно покрывает время только непрерывно: если между замерами прошло больше max_gap, старые значения
+    отбрасываются, иначе значение до простоя вместе с одним свежим выглядело бы как вся длительность.
+    """
+
+    def __init__(self, duration: float, max_gap=ALERT_MAX_GAP):
+        self.duration = duration
+        self.max_gap = max_gap
+        self.clear()
+
+    def clear(self):
+        self._values = deque()
+        self._min = deque()  # монотонно возрастающие кандидаты в минимум
+        self._max = deque()  # монотонно убывающие кандидаты в максимум
+        self._sum = 0.0
+
+    def add(self, timestamp: float, value: float):
+        if self._values and timestamp - self._values[-1][0] > self.max_gap:
+            self.clear()
+        self._values.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        # Оставляем одно значение на границе окна, чтобы span() мог покрыть всю длительность.
+        while len(self._values) > 1 and self._values[1][0] <= timestamp - self.duration:
+            expired, old = self._values.popleft()
+            self._sum -= old
+            if self._min[0][0] <= expired:
+                self._min.popleft()
+            if self._max[0][0] <= expired:
+                self._max.popleft()
+
+    def span(self) -> float:
+        return self._values[-1][0] - self._values[0][0] if self._values else 0.0
+
+    def min(self) -> float:
+        return self._min[0][1]
+
+    def max(self) -> float:
+        return self._max[0][1]
+
+    def mean(self) -> float:
+        return self._sum / len(self._values)
+
+
+class AlertEngine:
+    """Оценивает правила по скользящим окнам с гистерезисом и копит события для пакетной отправки."""
+
+    def __init__(self, rules=ALERT_RULES, rate_limit=ALERT_RATE_LIMIT):
+        self.rules = rules
+        self.pending = []
+        self._windows = {}
+        self._firing = set()
+        self._bucket = TokenBucket(rate_limit / 60, rate_limit)
+
+    def evaluate(self, host: str, snapshot: dict):
+        for rule in self.rules:
+            key = (host, rule.metric)
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = RollingWindow(rule.duration)
+            value = snapshot[rule.metric]
+            window.add(snapshot['timestamp'], value)
+            if key not in self._firing:
+                if window.span() >= rule.duration and window.min() > rule.threshold:
+                    self._firing.add(key)
+                    self.pending.append((host, rule.metric, f"📈 {host}: {rule.label} выше {rule.threshold:g}% "
+                                         f"уже {rule.duration / 60:g} мин (ср. {window.mean():.1f}%, макс {window.max():.1f}%)"))
+            elif value < rule.threshold - rule.hysteresis:
+                self._firing.discard(key)
+                self.pending.append((host, rule.metric, f"✅ {host}: {rule.label} снова в норме ({value:.1f}%)"))
+
+    def set_available(self, host: str, available: bool, error=None):
+        """Недоступность хоста тоже считается срабатыванием: одно оповещение на переход, а не на каждую проверку."""
+        key = (host, 'ssh')
+        if not available and key not in self._firing:
+            self._firing.add(key)
+            self.pending.append((host, 'ssh', f"🚨 {host}: сервер недоступен! Ошибка: {error}"))
+        elif available and key in self._firing:
+            self._firing.discard(key)
+            self.pending.append((host, 'ssh', f"✅ {host}: сервер снова доступен"))
+
+    def is_firing(self, host: str, metric: str) -> bool:
+        return (host, metric) in self._firing
+
+    def take_batch(self):
+        """Забирает все накопленные события одним пакетом, если позволяет лимит; иначе они ждут следующего окна."""
+        now = time.monotonic()
+        if not self.pending or self._bucket.ready_at(now) > now:
+            return []
+        self._bucket.take(now)
+        batch, self.pending = self.pending, []
+        return batch
+
+
+alert_engine = AlertEngine()
+
+async def evaluate_alerts(host: str, sampler: MetricsSampler):
+    async for snapshot in sampler.subscribe():
+        alert_engine.evaluate(host, snapshot)
+
+def render_alerts(batch: list, limit=4000) -> str:
+    text = f"🔔 Оповещения ({len(batch)})\n"
+    for n, (_, _, line) in enumerate(batch):
+        if len(text) + len(line) > limit:
+            return text + f"\n… и еще {len(batch) - n}"
+        text += f"\n{line}"
+    return text
+
 # --- Клавиатуры ---
 def get_main_menu_keyboard():
     return InlineKeyboardMarkup([
@@ -106,26 +1561,44 @@ def get_management_menu_keyboard():
         [InlineKeyboardButton("🔄 Рестарт службы", callback_data='restart_service_prompt')],
         [InlineKeyboardButton("📜 Получить лог", callback_data='get_log_info')],
         [InlineKeyboardButton("📈 Топ процессов", callback_data='get_top_processes')],
+        [InlineKeyboardButton("💾 Что занимает диск", callback_data='disk')],
         [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')],
     ])
 
-def get_top_processes_keyboard(back_target='open_management_menu'):
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💀 Завершить процесс", callback_data='kill_process_prompt')],
-        [InlineKeyboardButton("🔙 Назад", callback_data=back_target)],
-    ])
+def get_dashboard_keyboard(fleet_back=False):
+    rows = [[
+        InlineKeyboardButton("📉 История", callback_data='history_1h'),
+        InlineKeyboardButton("❌ Закрыть", callback_data='dashboard_stop'),
+    ]]
+    if fleet_back:
+        rows.insert(0, [InlineKeyboardButton("🌐 Весь парк", callback_data='host_select::dashboard_start')])
+    return InlineKeyboardMarkup(rows)
+
+def get_fleet_keyboard(ranked, action, last_row):
+    """Кнопки перехода к худшим хостам парка; action — обработчик, который откроется для выбранного хоста."""
+    buttons = [InlineKeyboardButton(f"🔎 {host}", callback_data=f'host_select:{hosts.index(host)}:{action}') for host, _ in ranked[:FLEET_WORST_COUNT]]
+    return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)] + [last_row])
+
+def get_history_keyboard(period):
+    periods = [InlineKeyboardButton(("• " if key == period else "") + key, callback_data=f'history_{key}') for key in HISTORY_PERIODS]
+    return InlineKeyboardMarkup([periods, [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')]])
 
 def get_back_keyboard(target='main_menu'):
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=target)]])
 
+def get_main_menu_text(context: ContextTypes.DEFAULT_TYPE) -> str:
+    if len(hosts) == 1:
+        return "👋 **Бот для мониторинга сервера**\n\nВыберите действие:"
+    target = f"🌐 Парк: {len(hosts)} хостов" if is_fleet_view(context) else f"🖥 Хост: `{selected_host(context)}`"
+    return f"👋 **Бот для мониторинга сервера**\n\n{target}\n\nВыберите действие:"
+
 # --- Основные обработчики ---
 @admin_only
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_jobs = context.job_queue.get_jobs_by_name(str(update.effective_user.id))
-    for job in current_jobs: job.schedule_removal()
+    stop_dashboards(context, update.effective_user.id)
     
     await update.message.reply_text(
-        "👋 **Бот для мониторинга сервера**\n\nВыберите действие:",
+        get_main_menu_text(context),
         reply_markup=get_main_menu_keyboard(),
         parse_mode=ParseMode.MARKDOWN
     )
@@ -135,7 +1608,7 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     await query.edit_message_text(
-        "👋 **Бот для мониторинга сервера**\n\nВыберите действие:",
+        get_main_menu_text(context),
         reply_markup=get_main_menu_keyboard(),
         parse_mode=ParseMode.MARKDOWN
     )
@@ -151,52 +1624,53 @@ async def open_management_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     )
 
 # --- Дашборд ---
+def stop_dashboards(context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Останавливает дашборды пользователя и отбрасывает их еще не отправленные правки."""
+    for job in context.job_queue.get_jobs_by_name(str(user_id)):
+        job.schedule_removal()
+        telegram_output.forget(job.chat_id, job.data['message_id'])
+
 async def update_dashboard_job(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
+    if telegram_output.is_dead(job.chat_id, job.data['message_id']):
+        telegram_output.forget(job.chat_id, job.data['message_id'])
+        job.schedule_removal()
+        return
+    host = job.data['host']
     try:
-        ram_cmd = "free -b | awk 'NR==2{printf \"%.1f\", $3/$2*100}'"
-        cpu_cmd = "uptime | awk -F'load average: ' '{print $2}'"
-        disk_cmd = "df -h / | awk 'NR==2{print $5}'"
-        
-        ram_percent = float(await execute_ssh_command(ram_cmd))
-        cpu_load = (await execute_ssh_command(cpu_cmd)).strip()
-        disk_usage = (await execute_ssh_command(disk_cmd)).strip()
-
-        ram_bar = f"[{'█' * int(ram_percent / 10) + '─' * (10 - int(ram_percent / 10))}] {ram_percent:.1f}%"
-        
-        text = (
-            f"📊 **Дашборд (обновляется каждые 10 сек)**\n\n"
-            f"🧠 **RAM:** {ram_bar}\n"
-            f"💻 **CPU Load:** `{cpu_load}`\n"
-            f"💾 **Диск (корень):** `{disk_usage}` занято"
-        )
-        await context.bot.edit_message_text(
-            chat_id=job.chat_id,
-            message_id=job.data['message_id'],
-            text=text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Закрыть", callback_data='dashboard_stop')]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-    except BadRequest as e:
-        if "Message is not modified" in str(e): pass
+        if host is None:
+            ranked = await collect_fleet()
+            text = f"📊 <b>Дашборд парка (обновляется каждые {DASHBOARD_INTERVAL:g} сек)</b>\n\n<pre>{render_fleet(ranked)}</pre>"
+            reply_markup = get_fleet_keyboard(ranked, 'dashboard_start', [InlineKeyboardButton("❌ Закрыть", callback_data='dashboard_stop')])
+            parse_mode = ParseMode.HTML
         else:
-            logger.error(f"Dashboard update error: {e}")
-            job.schedule_removal()
+            metrics = await get_metrics_sampler(host).get()
+            text = (
+                f"📊 **Дашборд (обновляется каждые {DASHBOARD_INTERVAL:g} сек)**\n\n"
+                + (f"🖥 **Хост:** `{host}`\n" if len(hosts) > 1 else "")
+                + f"💻 **CPU:** {format_bar(metrics['cpu'])}\n"
+                f"📉 **Load:** `{metrics['load1']:.2f}, {metrics['load5']:.2f}, {metrics['load15']:.2f}`\n"
+                f"🧠 **RAM:** {format_bar(metrics['ram'])}\n"
+                f"💾 **Диск (корень):** `{metrics['disk']:.0f}%` занято"
+            )
+            reply_markup = get_dashboard_keyboard(fleet_back=len(hosts) > 1)
+            parse_mode = ParseMode.MARKDOWN
     except Exception as e:
-        logger.error(f"Dashboard job failed: {e}")
-        job.schedule_removal()
+        logger.error(f"Dashboard data collection failed: {e}")
+        text, parse_mode = f"📊 Дашборд\n\n❌ Нет свежих данных: {e}", None
+        reply_markup = get_dashboard_keyboard(fleet_back=host is not None and len(hosts) > 1)
+    telegram_output.edit(job.chat_id, job.data['message_id'], text, reply_markup=reply_markup, parse_mode=parse_mode)
 
 @admin_only
 async def dashboard_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    current_jobs = context.job_queue.get_jobs_by_name(str(query.from_user.id))
-    for job in current_jobs: job.schedule_removal()
+    stop_dashboards(context, query.from_user.id)
     message = await query.edit_message_text("⏳ Запускаю дашборд...")
     context.job_queue.run_repeating(
-        update_dashboard_job, interval=10, first=0.1,
+        update_dashboard_job, interval=DASHBOARD_INTERVAL, first=0.1,
         chat_id=query.from_user.id,
-        data={'message_id': message.message_id},
+        data={'message_id': message.message_id, 'host': None if is_fleet_view(context) else selected_host(context)},
         name=str(query.from_user.id)
     )
 
@@ -204,36 +1678,132 @@ async def dashboard_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def dashboard_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    current_jobs = context.job_queue.get_jobs_by_name(str(query.from_user.id))
-    for job in current_jobs:
-        job.schedule_removal()
+    stop_dashboards(context, query.from_user.id)
     await query.delete_message()
 
+# --- Выбор хоста ---
+@admin_only
+async def host_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключает пользователя на хост (или обратно на весь парк) и открывает указанный экран.
+
+    Хост передается номером в инвентаре: имя (FQDN, возможно с двоеточием) не влезает в 64 байта callback_data.
+    """
+    _, host_id, action = update.callback_query.data.split(':', 2)
+    if host_id and not (host_id.isdigit() and int(host_id) < len(hosts)):
+        await update.callback_query.answer("Хост не найден в инвентаре.", show_alert=True)
+        return
+    context.user_data['host'] = hosts[int(host_id)] if host_id else None
+    await {'dashboard_start': dashboard_start, 'get_summary': get_server_summary}.get(action, main_menu)(update, context)
+
+@admin_only
+async def host_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        context.user_data['host'] = None
+        await update.message.reply_text(f"🌐 Выбран весь парк. Хосты: {', '.join(hosts)}", reply_markup=get_main_menu_keyboard())
+        return
+    host = context.args[0]
+    if host not in ssh_connections:
+        await update.message.reply_text(f"⚠️ Неизвестный хост. Доступны: {', '.join(hosts)}")
+        return
+    context.user_data['host'] = host
+    await update.message.reply_text(f"🖥 Выбран хост `{host}`.", reply_markup=get_main_menu_keyboard(), parse_mode=ParseMode.MARKDOWN)
+
+@admin_only
+async def fleet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выполняет команду на всех хостах парка с ограничением параллельности и присылает сводный отчет."""
+    if not context.args:
+        await update.message.reply_text("⚠️ **Формат:** `/fleet <команда>`", parse_mode=ParseMode.MARKDOWN)
+        return
+    command = " ".join(context.args)
+    msg = await update.message.reply_text(f"⏳ Выполняю на {len(hosts)} хостах: {command}")
+    await task_manager.submit(
+        ('fleet', command), f"{command} на {len(hosts)} хостах", lambda task: fleet_command_task(task, command),
+        msg.chat_id, msg.message_id, cache=False,
+    )
+
+async def fleet_command_task(task: Task, command: str) -> TaskResult:
+    done = 0
+
+    async def run(host):
+        nonlocal done
+        try:
+            return await get_ssh_connection(host).run(command)
+        finally:
+            done += 1
+            task.report(f"Готово {done} из {len(hosts)} хостов")
+
+    results = await fan_out(run)
+    report, failed = [], 0
+    for host, result in results.items():
+        if isinstance(result, BaseException):
+            failed += 1
+            report.append(f"===== {host}: ошибка =====\n{result!r}\n")
+        else:
+            failed += result.exit_status != 0
+            report.append(f"===== {host}: код {result.exit_status} =====\n{result.stdout}{result.stderr}\n")
+    return TaskResult(
+        f"🌐 `{command}`: успешно {len(results) - failed}, с ошибкой {failed}", ParseMode.MARKDOWN,
+        document=io.BytesIO("\n".join(report).encode('utf-8')), filename="fleet_report.txt",
+    )
+
+# --- История ---
+@admin_only
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    period = context.args[0] if context.args else '1h'
+    if period not in HISTORY_PERIODS:
+        await update.message.reply_text(f"⚠️ Период должен быть одним из: {', '.join(HISTORY_PERIODS)}")
+        return
+    await update.message.reply_text(
+        f"📉 <b>История за {period}</b>\n\n<pre>{render_history(selected_host(context), period)}</pre>",
+        reply_markup=get_history_keyboard(period), parse_mode=ParseMode.HTML
+    )
+
+@admin_only
+async def history_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    period = query.data.removeprefix('history_')
+    # История открывается поверх дашборда — его обновление останавливаем.
+    stop_dashboards(context, query.from_user.id)
+    await query.edit_message_text(
+        f"📉 <b>История за {period}</b>\n\n<pre>{render_history(selected_host(context), period)}</pre>",
+        reply_markup=get_history_keyboard(period), parse_mode=ParseMode.HTML
+    )
+
 # --- Сводка по серверу (Neofetch) ---
 @admin_only
 async def get_server_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if is_fleet_view(context):
+        await query.edit_message_text("⏳ Собираю сводку по парку...")
+        ranked = await collect_fleet()
+        await query.edit_message_text(
+            f"ℹ️ <b>Сводка по парку</b>\n\n<pre>{render_fleet(ranked, limit=len(ranked))}</pre>",
+            reply_markup=get_fleet_keyboard(ranked, 'get_summary', [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')]),
+            parse_mode=ParseMode.HTML
+        )
+        return
     await query.edit_message_text("⏳ Собираю сводку по серверу...")
 
-    command = "cat /etc/os-release | grep PRETTY_NAME | cut -d'\"' -f2; " \
-              "hostname; " \
-              "uptime -p; " \
-              "grep 'model name' /proc/cpuinfo | head -1 | cut -d':' -f2 | sed 's/^ *//'; " \
-              "free -h | awk '/^Mem:/ {print $3\" / \"$2}'; " \
-              "df -h / | awk 'NR==2 {print $3\" / \"$2\" (\"$5\")\"}'"
-    output = await execute_ssh_command(command)
-    
+    host = selected_host(context)
+    facts = {}
     try:
-        os_name, host, uptime, cpu, ram, disk = output.split('\n')
+        facts, metrics = await asyncio.gather(
+            fact_caches[host].get('os_name', 'hostname', 'cpu_model'), get_metrics_sampler(host).get()
+        )
+        os_name, hostname, cpu = facts['os_name'], facts['hostname'], facts['cpu_model']
+        uptime = format_uptime(metrics['uptime'])
+        ram = f"{format_bytes(metrics['ram_used'])} / {format_bytes(metrics['ram_total'])}"
+        disk = f"{format_bytes(metrics['disk_used'])} / {format_bytes(metrics['disk_total'])} ({metrics['disk']:.0f}%)"
         art = ["      .--.     ", "     |o_o |    ", "     |:_/ |    ", "    //   \ \   ", "   (|     | )  ", "  /'\_   _/`\  ", "  \___)=(___/  "]
-        data = [f"OS:      {os_name}", f"Host:    {host}", f"Uptime:  {uptime}", f"CPU:     {cpu}", f"RAM:     {ram}", f"Disk:    {disk}", ""]
+        data = [f"OS:      {os_name}", f"Host:    {hostname}", f"Uptime:  {uptime}", f"CPU:     {cpu}", f"RAM:     {ram}", f"Disk:    {disk}", ""]
         result = [art[i] + data[i] for i in range(len(art))]
         formatted_output = "\n".join(result)
         
         await query.edit_message_text(f"ℹ️ **Сводка по серверу**\n\n<pre>{formatted_output}</pre>", reply_markup=get_back_keyboard(), parse_mode=ParseMode.HTML)
     except Exception as e:
-        logger.error(f"Failed to create summary: {e}. Output: {output}")
+        logger.error(f"Failed to create summary: {e}. Facts: {facts}")
         await query.edit_message_text("❌ Не удалось создать сводку. Проверьте логи.", reply_markup=get_back_keyboard())
 
 # --- Другие команды ---
@@ -241,34 +1811,226 @@ async def get_server_summary(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def get_network_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("⏳ Получаю сетевую информацию...")
-    output = await execute_ssh_command("ss -tulnp")
-    await query.edit_message_text(f"🔌 **Активные сетевые подключения**\n\n<pre>{output}</pre>", reply_markup=get_back_keyboard(), parse_mode=ParseMode.HTML)
+    cache = fact_caches[selected_host(context)]
+    fresh = query.data.endswith(':fresh')
+    if fresh or cache.is_stale('listening'):
+        await query.edit_message_text("⏳ Получаю сетевую информацию...")
+    try:
+        output = (await cache.get('listening', fresh=fresh))['listening']
+    except Exception as e:
+        logger.error(f"Network info failed: {e!r}")
+        output = f"🚨 Не удалось подключиться к серверу или выполнить команду. Ошибка: {e}"
+    age = int(cache.age('listening'))
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Обновить", callback_data='get_network_info:fresh')],
+        [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')],
+    ])
+    try:
+        await query.edit_message_text(
+            f"🔌 <b>Активные сетевые подключения</b> (данные {age} сек назад)\n\n<pre>{html.escape(output)}</pre>",
+            reply_markup=keyboard, parse_mode=ParseMode.HTML
+        )
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
 
-@admin_only
-async def run_speedtest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text("🚀 Запускаю SpeedTest... Это может занять до минуты.")
-    output = await execute_ssh_command("speedtest-cli --simple")
+def parse_speedtest(output: str) -> TaskResult:
     try:
         ping = re.search(r"Ping: ([\d.]+) ms", output).group(1)
         download = re.search(r"Download: ([\d.]+) Mbit/s", output).group(1)
         upload = re.search(r"Upload: ([\d.]+) Mbit/s", output).group(1)
-        text = f"🌐 **Результаты SpeedTest**\n\n**Ping:** `{ping} ms`\n**Download:** `↓ {download} Mbit/s`\n**Upload:** `↑ {upload} Mbit/s`"
-        await query.edit_message_text(text, reply_markup=get_back_keyboard(), parse_mode=ParseMode.MARKDOWN)
     except AttributeError:
-        await query.edit_message_text(f"🌐 **Результат SpeedTest (raw)**\n\n<pre>{output}</pre>", reply_markup=get_back_keyboard(), parse_mode=ParseMode.HTML)
+        return TaskResult(f"🌐 <b>Результат SpeedTest (raw)</b>\n\n<pre>{html.escape(output)}</pre>", ParseMode.HTML)
+    text = f"🌐 **Результаты SpeedTest**\n\n**Ping:** `{ping} ms`\n**Download:** `↓ {download} Mbit/s`\n**Upload:** `↑ {upload} Mbit/s`"
+    return TaskResult(text, ParseMode.MARKDOWN)
+
+async def speedtest_task(task: Task, host: str) -> TaskResult:
+    """speedtest-cli без буферизации вывода: каждый этап (ping, download, upload) сразу виден в прогрессе."""
+    output = bytearray()
+    async def _run():
+        async with get_ssh_connection(host).open_channel("PYTHONUNBUFFERED=1 speedtest-cli --simple", timeout=120, deadline=120) as channel:
+            async with aclosing(iter_channel_output(channel)) as chunks:
+                async for out, err in chunks:
+                    output.extend(out + err)
+                    task.report(output.decode('utf-8', errors='replace').strip())
+    await asyncio.wait_for(_run(), 120)
+    result = parse_speedtest(output.decode('utf-8', errors='replace').strip())
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Запустить заново", callback_data='run_speedtest:fresh')],
+        [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')],
+    ])
+    return result._replace(reply_markup=keyboard)
+
+@admin_only
+async def run_speedtest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    host = selected_host(context)
+    await task_manager.submit(
+        ('speedtest', host), "SpeedTest (может занять до минуты)", lambda task: speedtest_task(task, host),
+        query.message.chat_id, query.message.message_id, fresh=query.data.endswith(':fresh'),
+    )
 
 # --- Управление процессами ---
+# Два среза /proc с интервалом в секунду: CPU% и IO считаются по текущему интервалу, а не за все время жизни процесса.
+PROCESS_SNAPSHOT_COMMAND = "; ".join([
+    "snap() { echo \"@ $(head -n 1 /proc/stat)\"; cat /proc/[0-9]*/stat 2>/dev/null; "
+    "grep -H -E '^(read|write)_bytes' /proc/[0-9]*/io 2>/dev/null; }",
+    "echo \"pagesize $(getconf PAGESIZE)\"",
+    "echo \"ncpu $(grep -c '^cpu[0-9]' /proc/stat)\"",
+    "echo \"clk_tck $(getconf CLK_TCK)\"",
+    "grep -H '^Uid:' /proc/[0-9]*/status 2>/dev/null",
+    "grep -H -E '^0::|name=systemd:' /proc/[0-9]*/cgroup 2>/dev/null",
+    "awk -F: '{print \"passwd\", $1, $3}' /etc/passwd",
+    "snap", "sleep 1", "snap",
+])
+PROCESS_SORTS = {'cpu': "CPU", 'rss': "RSS", 'io': "IO", 'threads': "Потоки"}
+PROCESS_GROUPS = {'none': "Процессы", 'user': "Пользователи", 'cgroup': "cgroup"}
+
+def parse_process_snapshot(output: str) -> list:
+    """Разбирает вывод PROCESS_SNAPSHOT_COMMAND в список процессов с дельтами за интервал между срезами."""
+    settings, uids, cgroups, users = {}, {}, {}, {}
+    samples = []  # по срезу: (сумма jiffies CPU, {pid: (comm, jiffies, threads, rss_pages)}, {pid: io_bytes})
+    for line in output.splitlines():
+        if line.startswith("@ "):
+            samples.append((sum(int(value) for value in line.split()[2:]), {}, {}))
+        elif line.startswith("/proc/"):
+            source, _, value = line.partition(":")
+            pid = source.split("/")[2]
+            if source.endswith("/io"):
+                samples[-1][2][pid] = samples[-1][2].get(pid, 0) + int(value.split()[1])
+            elif source.endswith("/status"):
+                uids[pid] = value.split()[1]
+            elif source.endswith("/cgroup"):
+                path = value.split(":", 2)[2]
+                if path != "/" or pid not in cgroups:
+                    cgroups[pid] = path
+        elif line[:1].isdigit() and samples:
+            pid, _, rest = line.partition(" ")
+            comm = rest[rest.index("(") + 1:rest.rindex(")")]
+            fields = rest[rest.rindex(")") + 2:].split()
+            samples[-1][1][pid] = (comm, int(fields[11]) + int(fields[12]), int(fields[17]), int(fields[21]))
+        elif line.startswith("passwd "):
+            _, name, uid = line.split()
+            users[uid] = name
+        elif " " in line:
+            key, value = line.split(" ", 1)
+            settings[key] = int(value)
+    if len(samples) < 2:
+        raise RuntimeError(f"Unexpected process snapshot output: {output[:200]}")
+    (total_before, before, io_before), (total_after, after, io_after) = samples[-2], samples[-1]
+    ncpu = settings.get('ncpu') or 1
+    # Длительность интервала — по счетчикам CPU самого хоста, а не по часам бота.
+    elapsed = max((total_after - total_before) / ncpu / settings.get('clk_tck', 100), 1e-3)
+    processes = []
+    for pid, (comm, jiffies, threads, rss) in after.items():
+        previous = before.get(pid)
+        cpu_jiffies = jiffies - previous[1] if previous else 0
+        processes.append({
+            'pid': int(pid),
+            'comm': comm,
+            'user': users.get(uids.get(pid), uids.get(pid, "?")),
+            'cgroup': cgroups.get(pid, "/"),
+            'cpu': cpu_jiffies / settings.get('clk_tck', 100) / elapsed * 100,
+            'rss': rss * settings.get('pagesize', 4096),
+            'io': max(io_after.get(pid, 0) - io_before.get(pid, 0), 0) / elapsed if pid in io_before else 0.0,
+            'threads': threads,
+        })
+    return processes
+
+def group_processes(processes: list, group: str) -> list:
+    if group == 'none':
+        return processes
+    groups = {}
+    for process in processes:
+        name = process[group]
+        item = groups.setdefault(name, {'name': name, 'count': 0, 'cpu': 0.0, 'rss': 0, 'io': 0.0, 'threads': 0})
+        item['count'] += 1
+        for key in ('cpu', 'rss', 'io', 'threads'):
+            item[key] += process[key]
+    return list(groups.values())
+
+process_snapshots = {}  # host -> (время среза, список процессов)
+
+async def get_process_snapshot(host: str, refresh=False) -> tuple:
+    """Срез процессов хоста из кэша; сервер опрашивается только при refresh или устаревании кэша."""
+    cached = process_snapshots.get(host)
+    if cached and not refresh and time.time() - cached[0] < PROCESS_CACHE_TTL:
+        return cached
+    result = await get_ssh_connection(host).run(PROCESS_SNAPSHOT_COMMAND)
+    process_snapshots[host] = (time.time(), parse_process_snapshot(result.stdout))
+    return process_snapshots[host]
+
+def render_processes(taken_at: float, processes: list, sort: str, group: str, page: int):
+    rows = sorted(group_processes(processes, group), key=lambda item: item[sort], reverse=True)
+    pages = max((len(rows) + PROCESS_PAGE_SIZE - 1) // PROCESS_PAGE_SIZE, 1)
+    page = min(page, pages - 1)
+    rows = rows[page * PROCESS_PAGE_SIZE:(page + 1) * PROCESS_PAGE_SIZE]
+    if group == 'none':
+        lines = ["   PID  CPU%    RSS   IO/s THR COMMAND"]
+        lines += [f"{p['pid']:>6} {p['cpu']:5.1f} {format_bytes(p['rss']):>6} {format_bytes(p['io']):>6} {p['threads']:>3} {p['comm'][:15]}" for p in rows]
+    else:
+        lines = [f"{PROCESS_GROUPS[group][:18]:<18}  N  CPU%    RSS   IO/s"]
+        lines += [f"{g['name'][-18:]:<18} {g['count']:>2} {g['cpu']:5.1f} {format_bytes(g['rss']):>6} {format_bytes(g['io']):>6}" for g in rows]
+    age = int(time.time() - taken_at)
+    text = (f"📈 <b>Процессы</b> · сортировка: {PROCESS_SORTS[sort]} · стр. {page + 1}/{pages}\n"
+            f"Срез {age} сек назад\n\n<pre>{html.escape(chr(10).join(lines))}</pre>")
+
+    def button(label, sort_=sort, group_=group, page_=page, active=False):
+        return InlineKeyboardButton(("• " if active else "") + label, callback_data=f'procs:{sort_}:{group_}:{page_}')
+
+    keyboard = [
+        [button(label, sort_=key, page_=0, active=key == sort) for key, label in PROCESS_SORTS.items()],
+        [button(label, group_=key, page_=0, active=key == group) for key, label in PROCESS_GROUPS.items()],
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(button("⬅️", page_=page - 1))
+    navigation.append(InlineKeyboardButton("🔄", callback_data=f'procs:{sort}:{group}:{page}:refresh'))
+    if page + 1 < pages:
+        navigation.append(button("➡️", page_=page + 1))
+    keyboard.append(navigation)
+    if group == 'none':
+        kill_buttons = [InlineKeyboardButton(f"💀 {p['pid']}", callback_data=f"kill_pick:{p['pid']}") for p in rows]
+        keyboard += [kill_buttons[i:i + 5] for i in range(0, len(kill_buttons), 5)]
+    keyboard.append([
+        InlineKeyboardButton("💀 Ввести PID", callback_data='kill_process_prompt'),
+        InlineKeyboardButton("🔙 Назад", callback_data='open_management_menu'),
+    ])
+    return text, InlineKeyboardMarkup(keyboard)
+
 @admin_only
 async def get_top_processes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("⏳ Получаю список процессов...")
-    command = "ps -eo pid,pcpu,pmem,comm --sort=-pcpu | head -n 11"
-    output = await execute_ssh_command(command)
-    await query.edit_message_text(f"📈 **Топ процессов по CPU**\n\n<pre>{output}</pre>", reply_markup=get_top_processes_keyboard(), parse_mode=ParseMode.HTML)
+    sort, group, page, refresh = 'cpu', 'none', 0, False
+    if query.data.startswith('procs:'):
+        _, sort, group, page, *flags = query.data.split(':')
+        page, refresh = int(page), 'refresh' in flags
+    host = selected_host(context)
+    if refresh or host not in process_snapshots:
+        await query.edit_message_text("⏳ Получаю список процессов...")
+    try:
+        taken_at, processes = await get_process_snapshot(host, refresh=refresh)
+    except Exception as e:
+        logger.error(f"Process snapshot failed for {host}: {e!r}")
+        await query.edit_message_text(f"❌ Не удалось получить список процессов: {e}", reply_markup=get_back_keyboard('open_management_menu'))
+        return
+    text, keyboard = render_processes(taken_at, processes, sort, group, page)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+
+@admin_only
+async def kill_process_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    pid = query.data.split(':')[1]
+    context.user_data['pid_to_kill'] = pid
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(f"✅ Да, завершить PID {pid}", callback_data=f'kill_process_yes')], [InlineKeyboardButton("❌ Отмена", callback_data='get_top_processes')]])
+    await query.edit_message_text(f"Вы уверены, что хотите завершить процесс с PID `{pid}`?", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
 
 async def kill_process_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -291,7 +2053,8 @@ async def kill_process_execute(update: Update, context: ContextTypes.DEFAULT_TYP
     pid = context.user_data.get('pid_to_kill')
     await query.answer()
     await query.edit_message_text(f"⏳ Завершаю процесс {pid}...")
-    output = await execute_ssh_command(f"kill {pid} && echo 'OK'")
+    output = await execute_ssh_command(f"kill {pid} && echo 'OK'", host=selected_host(context))
+    process_snapshots.pop(selected_host(context), None)
     text = f"✅ Процесс с PID `{pid}` успешно завершен." if "OK" in output else f"❌ Не удалось завершить процесс `{pid}`.\n<pre>{output}</pre>"
     await query.edit_message_text(text, reply_markup=get_back_keyboard('open_management_menu'), parse_mode=ParseMode.HTML)
 
@@ -303,16 +2066,21 @@ async def get_log_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(
         "📜 **Получение лога**\n\n"
         "Используйте команду `/logs`, чтобы получить файл с логами.\n\n"
-        "**Формат:**\n`/logs [кол-во строк] [путь к файлу]`\n\n"
+        "**Формат:**\n`/logs [-z] [кол-во строк] [путь к файлу]`\n"
+        "`-z` — сжать лог на сервере перед отправкой.\n\n"
         "**Примеры:**\n`/logs 500 /var/log/nginx/access.log`\n"
-        "`/logs /var/log/syslog` (вернет 200 строк по умолчанию)",
+        "`/logs /var/log/syslog` (вернет 200 строк по умолчанию)\n\n"
+        "`/follow [путь]` — присылать новые строки по мере появления, `/unfollow` — перестать.",
         reply_markup=get_back_keyboard('open_management_menu'),
         parse_mode=ParseMode.MARKDOWN
     )
 
 @admin_only
 async def view_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    args = context.args
+    args = list(context.args)
+    compress = bool(args) and args[0] == "-z"
+    if compress:
+        args = args[1:]
     lines = 200
     log_path = ""
 
@@ -324,33 +2092,268 @@ async def view_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(
             "⚠️ **Неверный формат команды.**\n\n"
-            "**Формат:** `/logs [кол-во строк] [путь]`\n"
+            "**Формат:** `/logs [-z] [кол-во строк] [путь]`\n"
             "**Пример:** `/logs 500 /var/log/syslog`",
             parse_mode=ParseMode.MARKDOWN
         )
         return
     
-    msg = await update.message.reply_text(f"⏳ Собираю последние {lines} строк из `{log_path}`...", parse_mode=ParseMode.MARKDOWN)
-    output = await execute_ssh_command(f"tail -n {lines} {log_path}")
+    host = selected_host(context)
+    msg = await update.message.reply_text(f"⏳ Собираю последние {lines} строк из {log_path}...")
+    await task_manager.submit(
+        ('logs', host, log_path, lines, compress), f"Лог {log_path} ({lines} строк)",
+        lambda task: log_download_task(task, host, log_path, lines, compress),
+        msg.chat_id, msg.message_id,
+    )
 
-    if "Ошибка" in output or "No such file" in output or not output:
-        await msg.edit_text(f"❌ Не удалось получить лог.\n`{output}`", parse_mode=ParseMode.MARKDOWN)
+def log_tail_command(log_path: str, lines: int, compress: bool) -> str:
+    """Команда выгрузки хвоста лога: последние lines строк, но не больше LOG_MAX_BYTES + 1 самых новых байт.
+
+    Лишний байт сверх лимита показывает, что лог обрезан. Обрезка идет до сжатия: обрезать уже сжатый
+    поток нельзя, получился бы битый архив.
+    """
+    command = f"tail -n {lines} -- {shlex.quote(log_path)} | tail -c {LOG_MAX_BYTES + 1}"
+    return f"{command} | gzip -c" if compress else command
+
+async def log_download_task(task: Task, host: str, log_path: str, lines: int, compress: bool) -> TaskResult:
+    # Сжатый поток может быть чуть больше исходного текста; канал читается с запасом, чтобы архив не обрезался.
+    limit = LOG_MAX_BYTES + 1 + (LOG_MAX_BYTES // 1000 + 1024 if compress else 0)
+    f = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        size, error, overflow = await download_command_output(
+            log_tail_command(log_path, lines, compress), f, limit, timeout=120, host=host,
+            progress=lambda written: task.report(f"Загружено {format_bytes(written)}"),
+        )
+        if error or not size:
+            raise RuntimeError(f"не удалось получить лог: {error or 'лог пуст'}")
+        if compress:
+            if overflow:
+                raise RuntimeError("сжатый лог превысил лимит загрузки")
+            # Размер исходного текста — в последних 4 байтах gzip (ISIZE, по модулю 2**32; лимит заведомо меньше).
+            f.seek(-4, io.SEEK_END)
+            source_size = int.from_bytes(f.read(4), 'little')
+        else:
+            source_size = size
+        truncated = source_size > LOG_MAX_BYTES
+    except BaseException:
+        f.close()
+        raise
+    f.seek(0)
+    caption = f"📋 Вот последние {lines} строк из лога `{log_path}`"
+    if truncated:
+        caption += f"\n⚠️ Обрезано до {format_bytes(LOG_MAX_BYTES)}"
+    return TaskResult(
+        caption, ParseMode.MARKDOWN, document=f,
+        filename=f"{os.path.basename(log_path)}.log" + (".gz" if compress else ""),
+    )
+
+async def follow_log_job(context: ContextTypes.DEFAULT_TYPE):
+    """Читает только дописанные с прошлого раза байты файла и присылает новые строки одним сообщением."""
+    job = context.job
+    data = job.data
+    path = shlex.quote(data['path'])
+    command = f"stat -c %s -- {path} && tail -c +{data['offset'] + 1} -- {path} | head -c {FOLLOW_MAX_BYTES}"
+    buffer = io.BytesIO()
+    try:
+        _, error, _ = await download_command_output(command, buffer, FOLLOW_MAX_BYTES + 32, host=data['host'])
+        if not buffer.getvalue():
+            raise RuntimeError(error or "пустой ответ")
+    except Exception as e:
+        logger.error(f"Follow of {data['path']} on {data['host']} failed: {e!r}")
+        job.schedule_removal()
+        await telegram_output.send_message(job.chat_id, f"❌ Слежение за {data['path']} остановлено: {e}")
         return
-    
-    temp_filename = ""
+
+    size_line, _, chunk = buffer.getvalue().partition(b"\n")
+    if int(size_line) < data['offset']:
+        # Файл обрезан или ротирован: со следующего раза читаем сначала.
+        data['offset'] = 0
+        await telegram_output.send_message(job.chat_id, f"♻️ {data['path']}: файл был обрезан или ротирован.")
+        return
+    # Незаконченную последнюю строку дочитаем в следующий раз, если только она одна не заняла весь лимит.
+    if b"\n" in chunk:
+        chunk = chunk[:chunk.rindex(b"\n") + 1]
+    elif len(chunk) < FOLLOW_MAX_BYTES:
+        return
+    data['offset'] += len(chunk)
+    text = chunk.decode('utf-8', errors='replace').rstrip("\n")
+    if len(text) > 3500:
+        text = "…" + text[-3500:]
+    await telegram_output.send_message(
+        job.chat_id, f"📜 <b>{html.escape(data['path'])}</b>\n<pre>{html.escape(text)}</pre>", parse_mode=ParseMode.HTML
+    )
+
+@admin_only
+async def follow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("⚠️ **Формат:** `/follow [путь]`", parse_mode=ParseMode.MARKDOWN)
+        return
+    host = selected_host(context)
+    log_path = " ".join(context.args)
+    result = await get_ssh_connection(host).run(f"stat -c %s -- {shlex.quote(log_path)}")
+    if result.exit_status != 0:
+        await update.message.reply_text(f"❌ Не удалось открыть `{log_path}`: `{result.stderr.strip()}`", parse_mode=ParseMode.MARKDOWN)
+        return
+    context.job_queue.run_repeating(
+        follow_log_job, interval=FOLLOW_INTERVAL, first=FOLLOW_INTERVAL,
+        chat_id=update.effective_chat.id,
+        data={'host': host, 'path': log_path, 'offset': int(result.stdout.strip())},
+        name=f"follow_{update.effective_user.id}"
+    )
+    await update.message.reply_text(f"👀 Слежу за `{log_path}`. Остановить: `/unfollow`", parse_mode=ParseMode.MARKDOWN)
+
+@admin_only
+async def unfollow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_path = " ".join(context.args)
+    stopped = 0
+    for job in context.job_queue.get_jobs_by_name(f"follow_{update.effective_user.id}"):
+        if not log_path or job.data['path'] == log_path:
+            job.schedule_removal()
+            stopped += 1
+    await update.message.reply_text(f"🛑 Остановлено слежений: {stopped}")
+
+# --- Поиск по логам ---
+class GrepIndex:
+    """Смещения совпадений в файле; повторный поиск сканирует только дописанный с прошлого раза хвост."""
+
+    def __init__(self, search_id: int, host: str, path: str, pattern: str):
+        self.id = search_id
+        self.host = host
+        self.path = path
+        self.pattern = pattern
+        self.scanned = 0
+        self.matches = 0  # всего совпадений в просмотренной части; в offsets — только последние GREP_MAX_MATCHES
+        self.offsets = array('q')
+        self._lock = asyncio.Lock()
+
+    @property
+    def capped(self) -> bool:
+        return self.matches > len(self.offsets)
+
+    async def update(self):
+        # Два одновременных «Обновить» не должны просканировать один и тот же участок дважды.
+        async with self._lock:
+            await self._update()
+
+    async def _update(self):
+        path = shlex.quote(self.path)
+        size = await get_ssh_connection(self.host).run(f"stat -c %s -- {path}")
+        if size.exit_status != 0:
+            raise RuntimeError(size.stderr.strip())
+        size = int(size.stdout)
+        if size < self.scanned:
+            # Файл обрезан или ротирован — старый индекс недействителен.
+            self.scanned, self.matches, self.offsets = 0, 0, array('q')
+        if size == self.scanned:
+            return
+        # Сканируем [scanned, end), где end — сразу за последним переводом строки до size: файл может расти
+        # во время поиска, а недописанная строка (и совпадение, разрезанное границей) достанется следующему
+        # проходу, как в follow_log_job. Длина недописанной строки берется из последнего мегабайта перед size.
+        window_start = max(self.scanned, size - 1024 * 1024)
+        window = f"tail -c +{window_start + 1} -- {path} | head -c {size - window_start}"
+        # awk печатает число совпадений и смещения только последних GREP_MAX_MATCHES из них —
+        # старые совпадения важны меньше новых.
+        command = (f"end=$(( {size} - $({window} | tail -n 1 | wc -c) * (1 - $({window} | tail -c 1 | wc -l)) )); "
+                   f"echo $end; tail -c +{self.scanned + 1} -- {path} | head -c $((end - {self.scanned})) "
+                   f"| grep -a -b -E -e {shlex.quote(self.pattern)} "
+                   f"| awk -F: -v n={GREP_MAX_MATCHES} '{{ring[NR % n] = $1}} "
+                   f"END {{print NR; for (i = (NR > n ? NR - n + 1 : 1); i <= NR; i++) print ring[i % n]}}'")
+        result = await get_ssh_connection(self.host).run(command, timeout=300)
+        if result.stderr.strip():
+            raise RuntimeError(result.stderr.strip())
+        end, total, *offsets = result.stdout.split()
+        self.matches += int(total)
+        self.offsets.extend(self.scanned + int(offset) for offset in offsets)
+        del self.offsets[:max(len(self.offsets) - GREP_MAX_MATCHES, 0)]
+        self.scanned = int(end)
+
+    def pages(self) -> int:
+        return max((len(self.offsets) + GREP_PAGE_SIZE - 1) // GREP_PAGE_SIZE, 1)
+
+    async def read_page(self, page: int) -> list:
+        """Читает с сервера только строки совпадений нужной страницы (новые совпадения — на первой)."""
+        end = len(self.offsets) - page * GREP_PAGE_SIZE
+        offsets = list(reversed(self.offsets[max(end - GREP_PAGE_SIZE, 0):max(end, 0)]))
+        if not offsets:
+            return []
+        path = shlex.quote(self.path)
+        command = "; ".join(
+            f"printf '%s\\n' \"$(tail -c +{offset + 1} -- {path} | head -n 1 | cut -c 1-300)\"" for offset in offsets
+        )
+        result = await get_ssh_connection(self.host).run(command)
+        return list(zip(offsets, result.stdout.split("\n")))
+
+
+grep_indexes = OrderedDict()  # (host, path, pattern) -> GrepIndex, последние GREP_CACHE_SIZE поисков
+
+def get_grep_index(host: str, path: str, pattern: str) -> GrepIndex:
+    key = (host, path, pattern)
+    if key in grep_indexes:
+        grep_indexes.move_to_end(key)
+    else:
+        search_id = max((index.id for index in grep_indexes.values()), default=0) + 1
+        grep_indexes[key] = GrepIndex(search_id, host, path, pattern)
+        while len(grep_indexes) > GREP_CACHE_SIZE:
+            grep_indexes.popitem(last=False)
+    return grep_indexes[key]
+
+async def render_grep_page(index: GrepIndex, page: int):
+    matches = await index.read_page(page)
+    header = (f"🔎 <b>{html.escape(index.pattern)}</b> в <code>{html.escape(index.path)}</code>\n"
+              f"Совпадений: {index.matches}{f' (показаны последние {len(index.offsets)})' if index.capped else ''}, "
+              f"просмотрено {format_bytes(index.scanned)}. Страница {page + 1}/{index.pages()}\n\n")
+    body = "\n".join(f"{offset}: {line}" for offset, line in matches) or "Совпадений нет."
+    text = header + f"<pre>{html.escape(body[:3500])}</pre>"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f'grep:{index.id}:{page - 1}'))
+    if page + 1 < index.pages():
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=f'grep:{index.id}:{page + 1}'))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data=f'grep:{index.id}:refresh')])
+    return text, InlineKeyboardMarkup(keyboard)
+
+@admin_only
+async def grep_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) < 2:
+        await update.message.reply_text(
+            "⚠️ **Формат:** `/grep <шаблон> <путь>`\n**Пример:** `/grep 'upstream timed out' /var/log/nginx/error.log`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    pattern, log_path = " ".join(context.args[:-1]).strip("'\""), context.args[-1]
+    msg = await update.message.reply_text("⏳ Ищу совпадения на сервере...")
+    index = get_grep_index(selected_host(context), log_path, pattern)
     try:
-        temp_filename = f"{os.path.basename(log_path)}_{uuid.uuid4()}.log"
-        with open(temp_filename, "w", encoding="utf-8") as f: f.write(output)
-        with open(temp_filename, "rb") as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=f,
-                caption=f"📋 Вот последние {lines} строк из лога `{log_path}`",
-                parse_mode=ParseMode.MARKDOWN
-            )
-        await msg.delete()
-    finally:
-        if temp_filename and os.path.exists(temp_filename): os.remove(temp_filename)
+        await index.update()
+        text, keyboard = await render_grep_page(index, 0)
+    except Exception as e:
+        logger.error(f"Grep for '{pattern}' in {log_path} failed: {e!r}")
+        await msg.edit_text(f"❌ Поиск не удался: {e}")
+        return
+    await msg.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+@admin_only
+async def grep_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, search_id, page = query.data.split(':')
+    index = next((index for index in grep_indexes.values() if index.id == int(search_id)), None)
+    if index is None:
+        await query.answer("Результаты поиска устарели, повторите /grep.", show_alert=True)
+        return
+    await query.answer()
+    try:
+        if page == 'refresh':
+            await index.update()
+            page = 0
+        text, keyboard = await render_grep_page(index, int(page))
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+    except Exception as e:
+        logger.error(f"Grep page failed: {e!r}")
+        await query.edit_message_text(f"❌ Не удалось прочитать страницу: {e}")
 
 async def restart_service_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -370,52 +2373,366 @@ async def restart_service_execute(update: Update, context: ContextTypes.DEFAULT_
     service_name = context.user_data.get('service_to_restart')
     await query.answer()
     await query.edit_message_text(f"⏳ Перезапускаю службу `{service_name}`...", parse_mode=ParseMode.MARKDOWN)
-    output = await execute_ssh_command(f"sudo systemctl restart {service_name} && echo 'OK'")
+    output = await execute_ssh_command(f"sudo systemctl restart {service_name} && echo 'OK'", host=selected_host(context))
     text = f"✅ Служба `{service_name}` успешно перезапущена." if "OK" in output else f"❌ Не удалось перезапустить службу `{service_name}`.\n<pre>{output}</pre>"
     await query.edit_message_text(text, reply_markup=get_back_keyboard('open_management_menu'), parse_mode=ParseMode.HTML)
 
+# --- Анализ диска ---
+# Все сканирование идет с минимальным приоритетом CPU и ввода-вывода, чтобы не мешать нагрузке на сервере.
+DISK_THROTTLE = 'throttle() { if command -v ionice >/dev/null 2>&1; then ionice -c 3 nice -n 19 "$@"; else nice -n 19 "$@"; fi; }'
+DISK_MOUNTS_COMMAND = "awk '$3 ~ /^(" + "|".join(DISK_FS_TYPES) + ")$/ && !seen[$2]++ {print $2}' /proc/mounts"
+
+def parse_mounts(output: str) -> list:
+    # В /proc/mounts пробелы и другие спецсимволы в путях записаны восьмеричными escape-последовательностями.
+    return [re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), line) for line in output.splitlines() if line]
+
+def disk_scan_command(root: str, paths: list) -> str:
+    """Полный обход: собственный размер каждого каталога (du -S, без подкаталогов) в пределах файловой системы root."""
+    quoted = " ".join(shlex.quote(path) for path in paths)
+    return "; ".join([
+        DISK_THROTTLE,
+        "printf 't\\t%s\\0' \"$(date +%s)\"",
+        f"printf 'f\\t%s\\0' \"$(stat -f -c '%b %f %S' {shlex.quote(root)})\"",
+        f"throttle du -x -S -B1 -0 {quoted} 2>/dev/null | sed -z 's/^/s\\t/'",
+    ])
+
+def disk_refresh_command(root: str, since: int, extra: list) -> str:
+    """Инкрементальный проход: каталоги с mtime новее since (плюс extra) и только их непосредственное содержимое."""
+    commands = [
+        DISK_THROTTLE,
+        "printf 't\\t%s\\0' \"$(date +%s)\"",
+        f"printf 'f\\t%s\\0' \"$(stat -f -c '%b %f %S' {shlex.quote(root)})\"",
+        f"printf 'r\\t%s\\0' \"$(stat -c %d {shlex.quote(root)})\"",
+        'list=$(mktemp) || exit 1',
+        "trap 'rm -f \"$list\"' EXIT; trap 'exit 1' TERM HUP",
+        f"throttle find {shlex.quote(root)} -xdev -type d -newermt @{since} -print0 2>/dev/null > \"$list\"",
+    ]
+    if extra:
+        commands.append(f"printf '%s\\0' {' '.join(shlex.quote(path) for path in extra)} >> \"$list\"")
+    # Глубина 0 — сам каталог, глубина 1 — его файлы и подкаталоги; %b — занятые блоки по 512 байт, как у du.
+    commands.append(
+        "sort -zu \"$list\" | throttle xargs -0 -r sh -c 'find \"$@\" -maxdepth 1 -printf \"e\\t%d\\t%y\\t%D\\t%b\\t%p\\0\"' sh 2>/dev/null"
+    )
+    return "; ".join(commands)
+
+async def iter_disk_records(connection: SSHConnection, command: str):
+    """Разбирает поток NUL-разделенных записей вида "тип\\tполя" по мере поступления."""
+    async with connection.open_channel(command, deadline=DISK_SCAN_TIMEOUT) as channel:
+        async with aclosing(iter_channel_output(channel)) as chunks:
+            tail = b""
+            async for out, _ in chunks:
+                *records, tail = (tail + out).split(b"\0")
+                for record in records:
+                    kind, _, rest = record.decode('utf-8', errors='replace').partition("\t")
+                    yield kind, rest
+
+
+class DirectoryIndex:
+    """Индекс размеров каталогов одной файловой системы хоста.
+
+    Хранит собственный размер каждого каталога; при обновлении пересчитываются только каталоги, чей mtime
+    изменился с прошлого прохода, и DISK_RESCAN_TOP самых крупных (файлы, которые растут на месте, mtime
+    каталога не меняют). Рекурсивные размеры считаются по требованию и кэшируются до следующего изменения.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.dirs = {}  # путь -> собственный размер, байт
+        self.children = {}  # путь -> множество подкаталогов
+        self.capacity = (0, 0)  # (всего, занято) на файловой системе
+        self.since = None  # время начала последнего успешного прохода, по часам сервера
+        self.updated = None
+        self._pending_since = None
+        self._totals = None
+        self._ids = {}
+        self._paths = []
+
+    def node_id(self, path: str) -> int:
+        if path not in self._ids:
+            self._ids[path] = len(self._paths)
+            self._paths.append(path)
+        return self._ids[path]
+
+    def path_of(self, node_id: int):
+        path = self._paths[node_id] if 0 <= node_id < len(self._paths) else None
+        return path if path in self.dirs else None
+
+    def _add(self, path: str, size: int):
+        if path not in self.dirs and path != self.root:
+            self.children.setdefault(os.path.dirname(path), set()).add(path)
+        self.dirs[path] = size
+        self._totals = None
+
+    def _remove(self, path: str):
+        self.children.get(os.path.dirname(path), set()).discard(path)
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            self.dirs.pop(current, None)
+            stack.extend(self.children.pop(current, ()))
+        self._totals = None
+
+    def totals(self) -> dict:
+        if self._totals is None:
+            totals = dict(self.dirs)
+            # Путь подкаталога всегда длиннее пути родителя, поэтому достаточно одного прохода от длинных к коротким.
+            for path in sorted(self.dirs, key=len, reverse=True):
+                parent = os.path.dirname(path)
+                if path != self.root and parent in totals:
+                    totals[parent] += totals[path]
+            self._totals = totals
+        return self._totals
+
+    def _header(self, kind: str, rest: str) -> bool:
+        if kind == 't':
+            # Отсчет берется от первого вызова прохода: досканирование новых подкаталогов его не сдвигает.
+            if self._pending_since is None:
+                self._pending_since = int(rest)
+        elif kind == 'f':
+            blocks, free, block_size = (int(value) for value in rest.split())
+            self.capacity = (blocks * block_size, (blocks - free) * block_size)
+        else:
+            return False
+        return True
+
+    async def _scan(self, connection: SSHConnection, paths: list, report):
+        count = 0
+        async with aclosing(iter_disk_records(connection, disk_scan_command(self.root, paths))) as records:
+            async for kind, rest in records:
+                if not self._header(kind, rest) and kind == 's':
+                    size, _, path = rest.partition("\t")
+                    self._add(path, int(size))
+                    count += 1
+                    if count % 5000 == 0:
+                        report(f"{count} каталогов")
+
+    async def refresh(self, connection: SSHConnection, report):
+        self._pending_since = None
+        if self.since is None:
+            self.dirs.clear()
+            self.children.clear()
+            self._totals = None
+            await self._scan(connection, [self.root], report)
+        else:
+            top = heapq.nlargest(DISK_RESCAN_TOP, self.dirs, key=self.dirs.get)
+            device, sizes, listed = None, {}, {}
+            command = disk_refresh_command(self.root, self.since - 1, top)
+            async with aclosing(iter_disk_records(connection, command)) as records:
+                async for kind, rest in records:
+                    if self._header(kind, rest):
+                        continue
+                    if kind == 'r':
+                        device = rest
+                    elif kind == 'e':
+                        depth, entry_type, dev, blocks, path = rest.split("\t", 4)
+                        if depth == '0':
+                            sizes[path] = sizes.get(path, 0) + int(blocks) * 512
+                            listed.setdefault(path, set())
+                        elif dev == device:
+                            parent = os.path.dirname(path)
+                            if entry_type == 'd':
+                                listed.setdefault(parent, set()).add(path)
+                            else:
+                                sizes[parent] = sizes.get(parent, 0) + int(blocks) * 512
+            added = []
+            for path, children in listed.items():
+                if path in self.dirs or path == self.root:
+                    self._add(path, sizes.get(path, 0))
+                for child in self.children.get(path, set()) - children:
+                    self._remove(child)
+                added += [child for child in children if child not in self.dirs]
+            # Вложенные друг в друга новые каталоги достаточно обойти один раз, от верхнего.
+            added = [path for path in added if not any(path.startswith(other + "/") for other in added)]
+            if added:
+                report(f"новых подкаталогов: {len(added)}")
+                await self._scan(connection, added, report)
+        self.since = self._pending_since
+        self.updated = time.monotonic()
+
+
+disk_indexes = {}  # хост -> {точка монтирования: DirectoryIndex}
+
+async def disk_index_task(task: Task, host: str) -> TaskResult:
+    connection = get_ssh_connection(host)
+    mounts = parse_mounts((await connection.run(DISK_MOUNTS_COMMAND)).stdout)
+    indexes = disk_indexes.setdefault(host, {})
+    for mount in list(indexes):
+        if mount not in mounts:
+            del indexes[mount]
+    for n, mount in enumerate(mounts, 1):
+        index = indexes.setdefault(mount, DirectoryIndex(mount))
+        report = lambda progress, n=n, mount=mount: task.report(f"{mount} ({n}/{len(mounts)}): {progress}")
+        report("сканирую" if index.since is None else "проверяю изменения")
+        await asyncio.wait_for(index.refresh(connection, report), DISK_SCAN_TIMEOUT)
+    text, keyboard = render_disk_mounts(host)
+    return TaskResult(text, ParseMode.HTML, keyboard)
+
+def render_disk_mounts(host: str):
+    host_id = hosts.index(host)
+    rows, buttons = [], []
+    for mount_id, (mount, index) in enumerate(disk_indexes.get(host, {}).items()):
+        total, used = index.capacity
+        percent = _percent(used, total)
+        rows.append(f"{mount[-20:]:<20} {format_bytes(used):>6}/{format_bytes(total):<6} {percent:3.0f}%")
+        if index.updated is not None:
+            buttons.append([InlineKeyboardButton(
+                f"💾 {mount} — {percent:.0f}%", callback_data=f'disk:{host_id}:{mount_id}:{index.node_id(mount)}'
+            )])
+    ages = [int(time.monotonic() - index.updated) for index in disk_indexes.get(host, {}).values() if index.updated]
+    text = (f"💾 <b>Диски {html.escape(host)}</b>\n<pre>{html.escape(chr(10).join(rows) or 'нет данных')}</pre>\n"
+            f"Индекс обновлен {max(ages, default=0)} сек назад")
+    buttons.append([
+        InlineKeyboardButton("🔄 Обновить индекс", callback_data=f'disk_refresh:{host_id}'),
+        InlineKeyboardButton("🔙 Назад", callback_data='main_menu'),
+    ])
+    return text, InlineKeyboardMarkup(buttons)
+
+def render_disk_dir(host: str, mount_id: int, index: DirectoryIndex, path: str):
+    host_id = hosts.index(host)
+    totals = index.totals()
+    children = sorted(index.children.get(path, ()), key=totals.get, reverse=True)
+    rows = [f"{format_bytes(totals[child]):>7}  {os.path.basename(child)[:30]}/" for child in children[:DISK_PAGE_SIZE]]
+    if len(children) > DISK_PAGE_SIZE:
+        rest = sum(totals[child] for child in children[DISK_PAGE_SIZE:])
+        rows.append(f"{format_bytes(rest):>7}  … еще {len(children) - DISK_PAGE_SIZE} каталогов")
+    text = (f"💾 <b>{html.escape(host)}</b>: <code>{html.escape(path)}</code>\n"
+            f"Всего {format_bytes(totals[path])}, файлы в самом каталоге {format_bytes(index.dirs[path])}\n\n"
+            f"<pre>{html.escape(chr(10).join(rows) or 'подкаталогов нет')}</pre>")
+    buttons = [[InlineKeyboardButton(
+        f"📁 {os.path.basename(child)[:30]} — {format_bytes(totals[child])}",
+        callback_data=f'disk:{host_id}:{mount_id}:{index.node_id(child)}'
+    )] for child in children[:DISK_PAGE_SIZE]]
+    up = (f'disk:{host_id}:{mount_id}:{index.node_id(os.path.dirname(path))}' if path != index.root else f'disk:{host_id}')
+    buttons.append([
+        InlineKeyboardButton("⬆️ Вверх", callback_data=up),
+        InlineKeyboardButton("🔄 Обновить", callback_data=f'disk_refresh:{host_id}'),
+    ])
+    return text, InlineKeyboardMarkup(buttons)
+
+@admin_only
+async def disk_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Анализ диска: точки монтирования, затем спуск по крупнейшим каталогам из индекса."""
+    query = update.callback_query
+    await query.answer()
+    parts = query.data.split(':')
+    host = hosts[int(parts[1])] if len(parts) > 1 and int(parts[1]) < len(hosts) else selected_host(context)
+    indexes = disk_indexes.get(host, {})
+    if len(parts) == 4 and int(parts[2]) < len(indexes):
+        index = list(indexes.values())[int(parts[2])]
+        path = index.path_of(int(parts[3]))
+        if path is not None:
+            text, keyboard = render_disk_dir(host, int(parts[2]), index, path)
+            await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+            return
+    fresh = indexes and all(index.updated and time.monotonic() - index.updated < DISK_INDEX_TTL for index in indexes.values())
+    if not fresh or query.data.startswith('disk_refresh'):
+        await task_manager.submit(
+            ('disk', host), f"Индекс диска {host}", lambda task: disk_index_task(task, host),
+            query.message.chat_id, query.message.message_id, cache=False,
+        )
+        return
+    text, keyboard = render_disk_mounts(host)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+
+# --- Фоновые операции ---
+@admin_only
+async def task_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    cancelled = task_manager.cancel(query.data.split(':')[1])
+    await query.answer("Отменяю..." if cancelled else "Операция уже завершена.")
+
+@admin_only
+async def tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tasks — идущие фоновые операции с кнопками отмены."""
+    active = task_manager.active()
+    if not active:
+        await update.message.reply_text("✅ Фоновых операций нет.")
+        return
+    lines = [f"{task.id}. {task.title} — {int(time.monotonic() - task.started)} сек" for task in active]
+    keyboard = [[InlineKeyboardButton(f"✖️ Отменить {task.id}", callback_data=f'task_cancel:{task.id}')] for task in active]
+    await update.message.reply_text("⏳ Фоновые операции:\n\n" + "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# --- Статистика бота ---
+@admin_only
+async def cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/cache — что закэшировано о каждом хосте и насколько давно."""
+    lines = []
+    for host in hosts:
+        lines.append(f"{host}:")
+        lines += [f"  {line}" for line in fact_caches[host].describe()] or ["  пусто"]
+    text = "\n".join(lines)
+    if len(text) > 3800:
+        text = text[:3800] + "\n…"
+    await update.message.reply_text(f"🗂 <b>Кэш фактов</b>\n<pre>{html.escape(text)}</pre>", parse_mode=ParseMode.HTML)
+
+@admin_only
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — задержки SSH, обработчиков, JobQueue и Bot API с момента запуска."""
+    text = instrumentation.render_text()
+    if len(text) > 3800:
+        text = text[:3800] + "\n…"
+    await update.message.reply_text(
+        f"📊 <b>Статистика бота</b> ({format_uptime(time.time() - instrumentation.started)})\n"
+        f"<pre>{html.escape(text)}</pre>",
+        parse_mode=ParseMode.HTML,
+    )
+
+
 # --- Фоновые задачи (Автомониторинг) ---
 # Эти функции не вызываются напрямую, а работают в фоне через job_queue
 async def check_server_availability(context: ContextTypes.DEFAULT_TYPE):
-    """Проверяет доступность сервера по SSH."""
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key = paramiko.RSAKey.from_private_key_file(SSH_KEY_PATH)
-        await asyncio.to_thread(
-             ssh.connect, SSH_HOST, port=SSH_PORT, username=SSH_USER, pkey=private_key, timeout=10
-        )
-        ssh.close()
-        logger.info("Availability check: Server is UP.")
-    except Exception as e:
-        logger.error(f"Availability check: Server is DOWN. Error: {e}")
-        await context.bot.send_message(chat_id=ADMIN_USER_ID, text=f"🚨 ВНИМАНИЕ! Сервер {SSH_HOST} недоступен! Ошибка: {e}")
+    """Проверяет доступность серверов парка по SSH."""
+    results = await fan_out(lambda host: get_ssh_connection(host).check(timeout=10))
+    for host, error in results.items():
+        available = not isinstance(error, BaseException)
+        if not available:
+            logger.error(f"Availability check: {host} is DOWN. Error: {error}")
+        alert_engine.set_available(host, available, error)
+    logger.info(f"Availability check: {sum(not isinstance(e, BaseException) for e in results.values())}/{len(results)} hosts UP.")
 
-async def check_thresholds(context: ContextTypes.DEFAULT_TYPE):
-    """Проверяет пороговые значения ресурсов."""
-    try:
-        cpu_cmd = "top -bn1 | grep 'Cpu(s)' | sed 's/.*, *\\([0-9.]*\\)%* id.*/\\1/' | awk '{print 100 - $1}'"
-        ram_cmd = "free | grep Mem | awk '{print $3/$2 * 100.0}'"
-        disk_cmd = "df / | tail -n 1 | awk '{print $5}' | sed 's/%//'"
-        
-        cpu_usage = float(await execute_ssh_command(cpu_cmd))
-        if cpu_usage > CPU_THRESHOLD:
-            await context.bot.send_message(chat_id=ADMIN_USER_ID, text=f"📈 ВНИМАНИЕ! Нагрузка CPU превысила порог: {cpu_usage:.2f}% (Порог: {CPU_THRESHOLD}%)")
+async def sample_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновый сэмплер: держит снимки метрик всех хостов свежими для дашбордов, порогов и сводки."""
+    results = await fan_out(lambda host: metrics_samplers[host].get(max_age=METRICS_SAMPLE_INTERVAL / 2))
+    for host, result in results.items():
+        if isinstance(result, BaseException):
+            logger.error(f"Metrics sampling failed for {host}: {result!r}")
 
-        ram_usage = float(await execute_ssh_command(ram_cmd))
-        if ram_usage > RAM_THRESHOLD:
-            await context.bot.send_message(chat_id=ADMIN_USER_ID, text=f"📈 ВНИМАНИЕ! Использование RAM превысило порог: {ram_usage:.2f}% (Порог: {RAM_THRESHOLD}%)")
-
-        disk_usage = float(await execute_ssh_command(disk_cmd))
-        if disk_usage > DISK_THRESHOLD:
-            await context.bot.send_message(chat_id=ADMIN_USER_ID, text=f"📈 ВНИМАНИЕ! Место на диске превысило порог: {disk_usage:.2f}% (Порог: {DISK_THRESHOLD}%)")
+async def flush_alerts_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет накопленные оповещения одним сообщением с учетом лимита частоты."""
+    batch = alert_engine.take_batch()
+    if not batch:
+        return
+    # К оповещению о заполненном диске сразу прикладывается переход в анализ диска этого хоста.
+    disk_hosts = sorted({host for host, metric, _ in batch if metric == 'disk' and alert_engine.is_firing(host, 'disk')})
+    keyboard = [[InlineKeyboardButton(f"💾 Что занимает диск: {host}", callback_data=f'disk:{hosts.index(host)}')] for host in disk_hosts[:5]]
+    try:
+        await telegram_output.send_message(ADMIN_USER_ID, render_alerts(batch), reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
     except Exception as e:
-        logger.error(f"Could not check thresholds. Error: {e}")
+        logger.error(f"Could not send alerts. Error: {e}")
+        alert_engine.pending[:0] = batch
 
 
 # --- Основная функция ---
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application() -> Application:
+    """Собирает Application со всеми обработчиками и фоновыми задачами; соединения уже должны быть созданы."""
+    request = InstrumentedRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        media_write_timeout=TELEGRAM_MEDIA_WRITE_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+    )
+    # Обновления обрабатываются по очереди: на этом держатся ConversationHandler'ы перезапуска службы
+    # и завершения процесса. Долгие обработчики (slow_commands и slow_callbacks ниже) выполняются без
+    # блокировки очереди, не больше SLOW_HANDLER_LIMIT одновременно.
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_BASE_URL)
+        .request(request)
+        .post_init(start_background_tasks).post_shutdown(stop_background_tasks).build()
+    )
 
     # --- Handlers ---
     conv_handlers = {
@@ -428,29 +2745,79 @@ def main():
         '^dashboard_start$': dashboard_start,
         '^dashboard_stop$': dashboard_stop,
         '^get_summary$': get_server_summary,
-        '^get_network_info$': get_network_info,
-        '^run_speedtest$': run_speedtest,
+        '^history_': history_view,
+        '^host_select:': host_select,
+        '^grep:': grep_page,
+        '^get_network_info': get_network_info,
+        '^run_speedtest': run_speedtest,
+        '^task_cancel:': task_cancel,
+        '^disk': disk_view,
         '^get_top_processes$': get_top_processes,
+        '^procs:': get_top_processes,
+        '^kill_pick:': kill_process_pick,
         '^get_log_info$': get_log_info,
         '^restart_service_yes$': restart_service_execute,
         '^kill_process_yes$': kill_process_execute,
     }
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("logs", view_logs_command))
+    command_handlers = {
+        "start": start,
+        "logs": view_logs_command,
+        "follow": follow_command,
+        "unfollow": unfollow_command,
+        "grep": grep_command,
+        "history": history_command,
+        "host": host_command,
+        "fleet": fleet_command,
+        "stats": stats_command,
+        "cache": cache_command,
+        "tasks": tasks_command,
+    }
+    # Обработчики с удаленной работой: не задерживают обновления, пришедшие следом, но их число ограничено.
+    slow_commands = {"logs", "follow", "grep", "fleet"}
+    slow_callbacks = {
+        '^host_select:', '^grep:', '^get_summary$', '^get_network_info', '^run_speedtest', '^disk',
+        '^get_top_processes$', '^procs:', '^restart_service_yes$', '^kill_process_yes$',
+    }
 
+    for command, handler in command_handlers.items():
+        handler = instrumented_handler(f"/{command}", handler)
+        if command in slow_commands:
+            handler = bounded_handler(handler)
+        application.add_handler(CommandHandler(command, handler, block=command not in slow_commands))
     for pattern, handler in callback_handlers.items():
-        application.add_handler(CallbackQueryHandler(handler, pattern=pattern))
+        handler = instrumented_handler(pattern, handler)
+        if pattern in slow_callbacks:
+            handler = bounded_handler(handler)
+        application.add_handler(CallbackQueryHandler(handler, pattern=pattern, block=pattern not in slow_callbacks))
     for handler in conv_handlers.values():
         application.add_handler(handler)
 
     # --- Настройка фоновых задач ---
     job_queue = application.job_queue
+    job_queue.run_repeating(sample_metrics_job, interval=METRICS_SAMPLE_INTERVAL, first=1)
     job_queue.run_repeating(check_server_availability, interval=120, first=15) 
-    job_queue.run_repeating(check_thresholds, interval=600, first=30)
+    job_queue.run_repeating(flush_alerts_job, interval=ALERT_BATCH_INTERVAL, first=ALERT_BATCH_INTERVAL)
+    return application
 
+def main():
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        # Без WEBHOOK_URL PTB зарегистрировал бы в Telegram адрес из WEBHOOK_LISTEN:WEBHOOK_PORT.
+        raise SystemExit("BOT_MODE=webhook требует WEBHOOK_URL — публичный HTTPS-адрес, который регистрируется в Telegram.")
+    init_ssh_connections()
+    application = build_application()
     logger.info("Bot started with new interactive UI and background monitoring...")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()